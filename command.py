@@ -31,16 +31,43 @@ if config['UploadScreenshot']:
     files = {'file': open(f'/tmp/{piName}.png', 'rb')}
     r = httpx.post(f'{BASE_URL}/UploadPiScreenshot', data=data, files=files)
 
+# TV power goes through one libcec session (the same cec package the client's
+# long-lived CEC worker uses) instead of a cec-client per step. Without the
+# package, or when the adapter can't be opened (the running client's CEC worker
+# holds it), fall back to cec-client as before.
+tv = None
+if config['TurnOnTV'] or config['TurnOffTV']:
+    try:
+        import cec
+        cec.init()
+        tv = cec.Device(cec.CECDEVICE_TV)
+    except Exception as e:
+        print(f"CEC adapter unavailable ({e}), using cec-client")
+        tv = None
+
+
+def cec_client(*lines):
+    subprocess.run(('cec-client', '-s', '-d', '1'), input='\n'.join(lines) + '\n',
+                   text=True, stdout=subprocess.DEVNULL, check=True)
+
+
 if config['TurnOnTV']:
-    echo = subprocess.Popen(('echo', 'on','0'), stdout=subprocess.PIPE)
-    cec = subprocess.check_output(('cec-client', '-s', '-d', '1'), stdin=echo.stdout)
-    echo.wait()
-    time.sleep(10)
-    echo = subprocess.Popen(('echo', 'as'), stdout=subprocess.PIPE)
-    cec = subprocess.check_output(('cec-client', '-s', '-d', '1'), stdin=echo.stdout)
-    echo.wait()
+    if tv is not None:
+        tv.power_on()
+        cec.set_active_source()
+        # Many TVs ignore the active source request until they have woken up
+        for _ in range(20):
+            if tv.is_on():
+                break
+            time.sleep(0.5)
+        cec.set_active_source()
+    else:
+        cec_client('on 0')
+        time.sleep(10)
+        cec_client('as')
 
 if config['TurnOffTV']:
-    echo = subprocess.Popen(('echo', 'standby', '0'), stdout=subprocess.PIPE)
-    cec = subprocess.check_output(('cec-client', '-s', '-d', '1'), stdin=echo.stdout)
-    echo.wait()
\ No newline at end of file
+    if tv is not None:
+        tv.standby()
+    else:
+        cec_client('standby 0')
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+"""Local stand-in for the piman API, for testing the client offline.
+
+Serves piConnect, UploadPiScreenshot, media downloads (with Range support) and
+the piEvents push stream. Schedules and commands are pushed with a POST to /push:
+
+    python3 dev_server.py --media ./media
+    PISIGNAGE_BASE_URL=http://127.0.0.1:8000/pi_manager_api PISIGNAGE_PUSH=1 python3 pisignage.py
+    curl -d '{"status": "Command", "scriptPath": "", "contentPath": "RotateLandscape"}' http://127.0.0.1:8000/push
+"""
+import argparse
+import gzip
+import hashlib
+import http.server
+import json
+import os
+import queue
+import re
+import threading
+import uuid
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+API_PREFIX = '/pi_manager_api'
+
+parser = argparse.ArgumentParser(description="Pi Signage stand-in server",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+parser.add_argument("--media", default="media", help="directory served under /pi_manager_api/media/")
+parser.add_argument("--heartbeat-interval", type=float, help="heartbeat interval hinted to clients, in seconds")
+
+# Current schedule handed out by piConnect, and one queue per connected push client
+schedule = {'status': 'NoChange', 'scriptPath': '', 'contentPath': ''}
+subscribers = []
+subscribersLock = threading.Lock()
+# Last known heartbeat state per device, rebuilt from deltas
+devices = {}
+# Queued commands for every device, handed out until each device acknowledges them
+commands = []
+
+
+def publish(event):
+    """Send an event to every connected push client, remembering it if it is a schedule.
+    Commands are queued with an id instead, so every device runs each one once.
+    """
+    global schedule
+    if event.get('status') == 'Command':
+        command = {'id': uuid.uuid4().hex, 'command': event['contentPath'],
+                   'scriptPath': event.get('scriptPath', '')}
+        commands.append(command)
+        event = {'status': 'NoChange', 'commands': [command]}
+    else:
+        schedule = event
+    with subscribersLock:
+        for q in subscribers:
+            q.put(event)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    mediaDir = 'media'
+    heartbeatInterval = None
+
+    def _send_json(self, payload, code=200):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _decode_heartbeat(self):
+        body = self._read_body()
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        if self.headers.get('Content-Type') == 'application/msgpack':
+            return msgpack.unpackb(body)
+        return json.loads(body or b'{}')
+
+    def do_POST(self):
+        path = self.path.split('?', 1)[0]
+        if path == f'{API_PREFIX}/piConnect':
+            heartbeat = self._decode_heartbeat()
+            negotiation = {'deltaOk': True, 'acceptEncodings': ['gzip'] + (['msgpack'] if msgpack else [])}
+            if self.heartbeatInterval:
+                negotiation['heartbeatInterval'] = self.heartbeatInterval
+            name = heartbeat.get('name')
+            if heartbeat.pop('delta', False):
+                if name not in devices:
+                    # Delta for a device we hold no state for, e.g. after a restart
+                    self._send_json({'status': 'NoChange', 'resync': True})
+                    return
+                devices[name].update(heartbeat)
+            else:
+                devices[name] = heartbeat
+            # Keep every delivered log entry once, in sequence order
+            logs = devices[name].setdefault('logs', {})
+            for entry in heartbeat.pop('logEntries', []):
+                logs[entry['seq']] = entry
+                print(f"[{name}] #{entry['seq']} {entry['level']}: {entry['msg']}")
+            if logs:
+                negotiation['logAck'] = max(logs)
+            done = devices[name].setdefault('commandsDone', {})
+            for ack in heartbeat.pop('commandAcks', []):
+                done[ack['id']] = ack
+                print(f"[{name}] command {ack['id']} {ack['command']}: {ack['result']}")
+            negotiation['commandAck'] = list(done)
+            negotiation['commands'] = [c for c in commands if c['id'] not in done]
+            # Mirror piman: report NoChange once the client holds the scheduled content
+            if schedule.get('contentHash') and heartbeat.get('hash') == schedule['contentHash']:
+                self._send_json({'status': 'NoChange', **negotiation})
+            else:
+                self._send_json({**schedule, **negotiation})
+        elif path == f'{API_PREFIX}/UploadPiScreenshot':
+            self._read_body()
+            self._send_json({'status': 'ok'})
+        elif path == '/push':
+            event = json.loads(self._read_body())
+            # Fill in the hash of served media so piConnect can answer NoChange
+            mediaPath = self._media_path(event.get('contentPath', ''))
+            if mediaPath and 'contentHash' not in event:
+                with open(mediaPath, 'rb') as f:
+                    event['contentHash'] = hashlib.md5(f.read()).hexdigest()
+            publish(event)
+            self._send_json({'pushed': event})
+        else:
+            self._send_json({'error': 'not found'}, 404)
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == f'{API_PREFIX}/piEvents':
+            self._stream_events()
+            return
+        mediaPath = self._media_path(path)
+        if mediaPath is None:
+            self._send_json({'error': 'not found'}, 404)
+            return
+        with open(mediaPath, 'rb') as f:
+            data = f.read()
+        etag = '"' + hashlib.md5(data).hexdigest() + '"'
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        ifRange = self.headers.get('If-Range')
+        if match and (ifRange is None or ifRange == etag):
+            start = int(match.group(1))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(data)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            end = min(int(match.group(2)), len(data) - 1) if match.group(2) else len(data) - 1
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+            data = data[start:end + 1]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _media_path(self, path):
+        """Map a media URL or path onto a file in the media directory"""
+        name = path.rsplit(f'{API_PREFIX}/media/', 1)
+        if len(name) != 2 or not name[1] or '/' in name[1]:
+            return None
+        mediaPath = os.path.join(self.mediaDir, name[1])
+        return mediaPath if os.path.isfile(mediaPath) else None
+
+    def _stream_events(self):
+        q = queue.Queue()
+        with subscribersLock:
+            subscribers.append(q)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        try:
+            while True:
+                try:
+                    event = q.get(timeout=15)
+                    self.wfile.write(f'data: {json.dumps(event)}\n\n'.encode())
+                except queue.Empty:
+                    # Comment line keeps the connection and the client's read timeout alive
+                    self.wfile.write(b': ping\n\n')
+                self.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            with subscribersLock:
+                subscribers.remove(q)
+            self.close_connection = True
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    Handler.mediaDir = args.media
+    Handler.heartbeatInterval = args.heartbeat_interval
+    server = http.server.ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    print(f"Stand-in piman listening on http://{args.host}:{args.port}{API_PREFIX}")
+    server.serve_forever()
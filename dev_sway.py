@@ -0,0 +1,138 @@
+#!/usr/bin/python
+"""Local stand-in for Sway's IPC socket, for testing display handling without a compositor.
+
+Answers RUN_COMMAND (output transform/mode/power/dpms, focus, scratchpad), GET_OUTPUTS,
+GET_TREE and SUBSCRIBE, and sends output events to subscribers whenever an
+output changes. 'nop hotplug <output>' simulates plugging or unplugging one:
+
+    python3 dev_sway.py --socket /tmp/sway-dev.sock
+    SWAYSOCK=/tmp/sway-dev.sock python3 pisignage.py
+    SWAYSOCK=/tmp/sway-dev.sock swaymsg nop hotplug HDMI-A-2
+"""
+import argparse
+import json
+import os
+import re
+import socketserver
+import struct
+import threading
+
+MAGIC = b'i3-ipc'
+RUN_COMMAND = 0
+SUBSCRIBE = 2
+GET_OUTPUTS = 3
+GET_TREE = 4
+EVENT_OUTPUT = 0x80000001
+
+parser = argparse.ArgumentParser(description="Sway IPC stand-in",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("--socket", default="/tmp/sway-dev.sock", help="IPC socket path")
+parser.add_argument("--mode", default="1920x1080", help="mode of the initial HDMI-A-1 output")
+
+outputs = {}
+subscribers = []
+stateLock = threading.Lock()
+
+
+def make_output(name, mode):
+    width, height = (int(v) for v in mode.split('x'))
+    return {'name': name, 'active': True, 'power': True, 'dpms': True, 'transform': 'normal',
+            'current_mode': {'width': width, 'height': height, 'refresh': 60000}}
+
+
+def send(conn, messageType, payload):
+    body = json.dumps(payload).encode()
+    conn.sendall(MAGIC + struct.pack('=II', len(body), messageType) + body)
+
+
+def output_changed():
+    """Tell every subscriber an output changed, like Sway's (detail free) output event"""
+    for conn in list(subscribers):
+        try:
+            send(conn, EVENT_OUTPUT, {'change': 'unspecified'})
+        except OSError:
+            subscribers.remove(conn)
+
+
+def run_command(command):
+    """Apply one command to the fake outputs, returning Sway's per-command result"""
+    match = re.match(r'\[pid=\d+\]\s+(.+)$', command)
+    if match:
+        # Window commands on a player, e.g. focus or moving the kiosk to the scratchpad
+        actions = {'focus', 'move scratchpad', 'scratchpad show', 'floating disable', 'fullscreen enable'}
+        return {'success': all(a.strip() in actions for a in match.group(1).split(','))}
+    match = re.match(r'nop hotplug (\S+)$', command)
+    if match:
+        name = match.group(1)
+        if name in outputs:
+            del outputs[name]
+        else:
+            outputs[name] = make_output(name, '1920x1080')
+        output_changed()
+        return {'success': True}
+    match = re.match(r"output\s+'?(\S+?)'?\s+(transform|mode|power|dpms)\s+(\S+)$", command)
+    if not match:
+        return {'success': False, 'error': f'Unknown/invalid command: {command}'}
+    name, setting, value = match.groups()
+    targets = list(outputs.values()) if name == '*' else [outputs[name]] if name in outputs else []
+    for output in targets:
+        if setting == 'transform':
+            output['transform'] = 'normal' if value == '0' else value
+        elif setting == 'mode':
+            width, height = (int(v) for v in value.split('@')[0].split('x'))
+            output['current_mode'].update(width=width, height=height)
+        else:
+            output['power'] = output['dpms'] = value == 'on'
+    if targets:
+        output_changed()
+    return {'success': bool(targets)}
+
+
+class Handler(socketserver.BaseRequestHandler):
+    def _recv_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError()
+            data += chunk
+        return data
+
+    def handle(self):
+        try:
+            while True:
+                header = self._recv_exact(len(MAGIC) + 8)
+                length, messageType = struct.unpack('=II', header[len(MAGIC):])
+                payload = self._recv_exact(length).decode()
+                with stateLock:
+                    if messageType == RUN_COMMAND:
+                        reply = [run_command(c.strip()) for c in payload.split(';') if c.strip()]
+                    elif messageType == SUBSCRIBE:
+                        reply = {'success': 'output' in json.loads(payload)}
+                    elif messageType == GET_OUTPUTS:
+                        reply = list(outputs.values())
+                    elif messageType == GET_TREE:
+                        reply = {'id': 1, 'name': 'root', 'pid': None, 'nodes': [], 'floating_nodes': []}
+                    else:
+                        reply = {'success': False}
+                    send(self.request, messageType, reply)
+                    if messageType == SUBSCRIBE:
+                        subscribers.append(self.request)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            if self.request in subscribers:
+                subscribers.remove(self.request)
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    outputs['HDMI-A-1'] = make_output('HDMI-A-1', args.mode)
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    print(f"Sway IPC stand-in on {args.socket}")
+    Server(args.socket, Handler).serve_forever()
@@ -4,16 +4,39 @@ server returns what content the pi should be displaying
 """
 from traceback import print_exc
 import subprocess
+import threading
+import asyncio
 import datetime
+import collections
+import concurrent.futures
 import hashlib
+import http.server
+import gzip
+import mmap
 import psutil
+import queue
 import httpx
 import magic
 import time
+import glob
+import shutil
+import socket
+import struct
 import re
+import sys
 # import gi
 import os
+import json
 import platform
+import random
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cec
+except ImportError:
+    cec = None
 
 # gi.require_version('Gdk', '3.0')
 # from gi.repository import Gdk
@@ -23,9 +46,54 @@ if '-dev-' in PI_NAME.lower():
     BASE_URL = 'https://piman.sagebrush.dev/pi_manager_api'
 else:
     BASE_URL = 'https://piman.sagebrush.work/pi_manager_api'
+# Point at another piman, e.g. the local stand-in in dev_server.py
+BASE_URL = os.environ.get('PISIGNAGE_BASE_URL', BASE_URL)
 
 PI_CLIENT_VERSION = '2.8.4b'
 
+# Pooled clients reuse kept-alive connections for heartbeats, uploads and
+# downloads instead of paying a TLS handshake each.
+# HTTP/2 is used when the optional h2 package is installed.
+HTTP2_ENABLED = os.environ.get('PISIGNAGE_HTTP2', '1') == '1'
+HTTP_MAX_CONNECTIONS = int(os.environ.get('PISIGNAGE_HTTP_MAX_CONNECTIONS', 4))
+HTTP_MAX_KEEPALIVE = int(os.environ.get('PISIGNAGE_HTTP_MAX_KEEPALIVE', 2))
+HTTP_KEEPALIVE_EXPIRY = 120
+httpClient = None
+# Content downloads get a pool of their own: segmented downloads hold a connection
+# per range, which would otherwise leave none for the heartbeat and screenshot uploads
+downloadClient = None
+# Latest timing breakdown per endpoint, reported in the heartbeat
+httpTimings = {}
+
+# Optional server push channel. While the event stream is connected schedule
+# changes and commands arrive immediately and the heartbeat can run slower;
+# when it drops the client falls back to the normal 30 second poll.
+PUSH_ENABLED = os.environ.get('PISIGNAGE_PUSH', '0') == '1'
+PUSH_HEARTBEAT_INTERVAL = int(os.environ.get('PISIGNAGE_PUSH_HEARTBEAT_INTERVAL', 120))
+pushConnected = False
+
+# Heartbeat scheduling. Every wait is jittered so a fleet never beats in lockstep,
+# failures back off exponentially up to a cap so a recovering piman isn't flooded,
+# and piman can set the interval with 'heartbeatInterval' in its response.
+HEARTBEAT_INTERVAL = 30
+HEARTBEAT_JITTER = 0.2
+HEARTBEAT_MIN_INTERVAL = 5
+HEARTBEAT_MAX_BACKOFF = 600
+heartbeatInterval = HEARTBEAT_INTERVAL
+# Seconds without reaching piman before networking is restarted, then the device rebooted
+NETWORK_RESTART_AFTER = 30 * 60
+REBOOT_AFTER = 60 * 60
+
+# Heartbeat deltas. The first heartbeat carries every field and doubles as the
+# handshake; once piman answers with deltaOk later heartbeats only carry fields
+# that changed and log lines it has not seen. A resync in any response makes the
+# next heartbeat full again. acceptEncodings in the response enables gzip or
+# MessagePack request bodies.
+HEARTBEAT_ALWAYS_FIELDS = ('name', 'hash')
+heartbeatDeltaOk = False
+heartbeatEncoding = None
+heartbeatLastSent = {}
+
 
 def get_device_model():
     """Dynamically detect the device model.
@@ -103,34 +171,942 @@ OS_INFO = get_os_info()
 
 browser = 'firefox'
 browser_flags = '--kiosk'
-logList = []
+# Seconds to wait for a new player window before the old player is killed anyway
+PLAYER_READY_TIMEOUT = 20
 sessionType = ""
 
-def downloadFile(url, dest):
+FALLBACK_IMAGE_URL = 'https://piman.sagebrush.work/pi_manager_api/media/Content_69eab3397e544073d0feeaae.jpg'
+
+# Persistent, content-addressed media cache. Blobs are stored under their md5
+# and the index maps each content URL to its blob, so a schedule that flips
+# between a few assets only downloads each one once.
+CACHE_DIR = os.path.expanduser(os.environ.get('PISIGNAGE_CACHE_DIR', '~/.cache/pisignage'))
+# The link to the blob on screen and the control page that plays it (which refers to
+# it as 'signageFile', so both share a directory). Kept per cache directory so several
+# clients on one host don't clear each other's link.
+SIGNAGE_FILE = os.path.join(CACHE_DIR, 'signageFile')
+CONTROL_FILE = os.path.join(CACHE_DIR, 'controlFile.html')
+MEDIA_CACHE_DIR = os.path.join(CACHE_DIR, 'media')
+MEDIA_INDEX_PATH = os.path.join(CACHE_DIR, 'media_index.json')
+# Byte budget for cached media, least recently used blobs are evicted past this
+CACHE_MAX_BYTES = int(os.environ.get('PISIGNAGE_CACHE_MAX_BYTES', 4 * 1024 * 1024 * 1024))
+mediaIndex = None
+# Guards mediaIndex, which the display task, prefetch, transcoder and peer server share
+mediaIndexLock = threading.RLock()
+# Per URL (or peer digest) locks so two callers never stream into one staging file
+downloadLocks = {}
+# Times a dropped download is resumed before giving up until the next heartbeat
+DOWNLOAD_ATTEMPTS = 5
+# Large assets are fetched as this many concurrent byte ranges when the server
+# supports Range requests, which fills high-latency links a single stream can't
+DOWNLOAD_SEGMENTS = int(os.environ.get('PISIGNAGE_DOWNLOAD_SEGMENTS', 4))
+DOWNLOAD_SEGMENT_MIN_BYTES = 16 * 1024 * 1024
+# Bandwidth ceilings in bytes/s (0 = unlimited) for content about to go on screen
+# and for background prefetch, so a download never starves a live page. Both are
+# lifted inside the full speed window ('HH:MM-HH:MM', may cross midnight).
+DOWNLOAD_MAX_RATE = int(os.environ.get('PISIGNAGE_DOWNLOAD_MAX_RATE', 0))
+PREFETCH_MAX_RATE = int(os.environ.get('PISIGNAGE_PREFETCH_MAX_RATE', 0))
+DOWNLOAD_FULL_SPEED_HOURS = os.environ.get('PISIGNAGE_DOWNLOAD_FULL_SPEED_HOURS', '')
+# Devices on the same LAN announce the blobs they cache over multicast and serve
+# them to each other over HTTP, so a site pulls each asset over the WAN once.
+# Peer bytes are only accepted when they match the content hash piman expects.
+PEERS_ENABLED = os.environ.get('PISIGNAGE_PEERS', '0') == '1'
+PEER_GROUP = os.environ.get('PISIGNAGE_PEER_GROUP', '239.255.42.99')
+PEER_ANNOUNCE_PORT = int(os.environ.get('PISIGNAGE_PEER_ANNOUNCE_PORT', 47615))
+# 0 picks a free port, which lets several clients share one host for testing
+PEER_HTTP_PORT = int(os.environ.get('PISIGNAGE_PEER_HTTP_PORT', 47616))
+PEER_ANNOUNCE_INTERVAL = 30
+# Most recently used digests per announcement, keeps it within one datagram
+PEER_ANNOUNCE_MAX_DIGESTS = 500
+# {peer id: {'ip': str, 'port': int, 'digests': set, 'seen': monotonic}}
+peers = {}
+peerId = os.urandom(8).hex()
+peerServer = None
+peerStats = {'fromPeers': 0, 'served': 0}
+# md5 memo keyed by real path, valid while (inode, size, mtime) are unchanged
+checksumCache = {}
+
+# Durable log ring buffer. Every entry gets a monotonic sequence number and is
+# appended to disk, so logs written while offline or just before a crash are
+# still delivered; the heartbeat ships entries piman has not acknowledged yet.
+LOG_PATH = os.path.join(CACHE_DIR, 'logs.jsonl')
+LOG_ACK_PATH = os.path.join(CACHE_DIR, 'logs.ack')
+LOG_BUFFER_SIZE = 2000
+# Entries per heartbeat, a backlog after an outage drains over a few heartbeats
+LOG_BATCH_SIZE = 200
+# Lines kept in the legacy piLogs field
+LEGACY_LOG_LINES = 51
+logBuffer = collections.deque(maxlen=LOG_BUFFER_SIZE)
+logLock = threading.Lock()
+logSequence = 0
+logAckSequence = 0
+logLinesOnDisk = 0
+logsLoaded = False
+
+# Commands run exactly once. Each carries an id; ids already run are kept on disk
+# so a restart (or a Restart command) never runs one again, and results are
+# acknowledged in the heartbeat until piman confirms it has them.
+COMMANDS_PATH = os.path.join(CACHE_DIR, 'commands.json')
+COMMAND_HISTORY = 500
+# {id: result}, oldest first
+executedCommands = None
+# Results not yet confirmed by piman: [{'id', 'command', 'result', 'time'}]
+commandAcks = []
+# Legacy id-less Command status last run, it repeats every heartbeat until changed
+legacyCommand = None
+# Commands block (reboot, scripts, Sway and CEC round trips), so they run on one
+# worker thread, in the order piman sent them, instead of on the event loop
+commandExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+commandsLock = threading.RLock()
+
+# In-process metrics sampler, read from /proc and /sys into a fixed-size series
+METRICS_SAMPLE_INTERVAL = 5
+# Ten minutes of history at the default interval
+metricsHistory = collections.deque(maxlen=120)
+SOC_TEMP_PATH = '/sys/class/thermal/thermal_zone0/temp'
+# Raspberry Pi firmware throttling bits, same value as `vcgencmd get_throttled`
+THROTTLED_PATH = '/sys/devices/platform/soc/soc:firmware/get_throttled'
+
+# One long-lived CEC session keeps the adapter open, so TV power and input
+# commands take milliseconds instead of a full libcec bus initialisation each.
+# Commands are queued to the worker thread that owns the adapter.
+CEC_POLL_INTERVAL = 60
+# Many TVs ignore the active source request while they are still powering up
+CEC_ACTIVE_SOURCE_RETRY = 8
+cecQueue = queue.Queue()
+cecThread = None
+# 'on', 'standby' or None when unknown, and the HDMI input last selected
+tvPower = None
+tvInput = None
+
+# Screenshots are captured scaled down and compared tile by tile with the last
+# uploaded frame; unchanged frames are not uploaded. The interval shortens right
+# after a content switch and backs off while the display is stable.
+SCREENSHOT_SCALE = float(os.environ.get('PISIGNAGE_SCREENSHOT_SCALE', 0.5))
+SCREENSHOT_FORMAT = os.environ.get('PISIGNAGE_SCREENSHOT_FORMAT', 'jpeg')
+SCREENSHOT_QUALITY = 70
+SCREENSHOT_MIN_INTERVAL = 10
+SCREENSHOT_INTERVAL = 30
+SCREENSHOT_MAX_INTERVAL = 300
+# Upload even an unchanged frame this often so the dashboard can tell it is fresh
+SCREENSHOT_MAX_AGE = 1800
+# The frame is split into a GRID x GRID set of tiles, a tile counts as changed when
+# its mean brightness moves by more than TILE_DELTA, and the frame as changed when
+# more than TILES tiles did
+SCREENSHOT_HASH_GRID = 16
+SCREENSHOT_HASH_TILE_DELTA = 4
+SCREENSHOT_HASH_TILES = 1
+lastScreenshotHash = None
+lastScreenshotUpload = 0
+# Set by display tasks after a content switch to capture the new content promptly
+screenshotWake = None
+
+# ffmpeg capabilities are probed once per boot, media metadata once per asset
+FFMPEG_CAPS_PATH = os.path.join(CACHE_DIR, 'ffmpeg_caps.json')
+MEDIA_META_PATH = os.path.join(CACHE_DIR, 'media_meta.json')
+ffmpegCaps = None
+mediaMeta = None
+
+# Measured decode capability. A one-time benchmark decodes synthetic clips with
+# every available decoder and records the frame rate each one sustains; video
+# playback decisions and decoder choice come from that profile.
+DECODE_PROFILE_PATH = os.path.join(CACHE_DIR, 'decode_profile.json')
+BENCH_DIR = os.path.join(CACHE_DIR, 'bench')
+BENCH_RESOLUTIONS = [(1280, 720), (1920, 1080), (3840, 2160)]
+# Encoder used to make each codec's test clip
+BENCH_ENCODERS = {'h264': 'libx264', 'hevc': 'libx265'}
+BENCH_FRAMES = 90
+# Decoded frame rate must beat the stream's by this margin to count as playable
+DECODE_HEADROOM = 1.1
+decodeProfile = None
+
+# Optional background transcoding of videos the hardware decoders can't handle
+# into an H.264/HEVC rendition sized for the connected display. It only runs
+# while the device is idle, niced and in the idle I/O class, and is paused
+# whenever the CPU shows contention so what is on screen never suffers.
+TRANSCODE_ENABLED = os.environ.get('PISIGNAGE_TRANSCODE', '0') == '1'
+# PSI "some avg10" for /proc/pressure/cpu above which transcoding pauses
+TRANSCODE_MAX_CPU_PRESSURE = 5.0
+TRANSCODE_CHECK_INTERVAL = 5
+transcodeQueue = collections.deque()
+
+# Local playlist scheduler. A "Playlist" status carries every item with its
+# duration, optional daily (HH:MM) or absolute (ISO) start/end window and a loop
+# flag; the client rotates through it on its own timer, prefetching upcoming
+# items so transitions are instant and survive network outages.
+PLAYLIST_DEFAULT_DURATION = 30
+# Items whose window opens within this many seconds are prefetched as well
+PLAYLIST_PREFETCH_AHEAD = 3600
+currentPlaylist = None
+playlistTask = None
+prefetchTask = None
+playingItem = None
+# Cache blobs that eviction must leave alone, e.g. prefetched playlist items
+pinnedDigests = set()
+
+# Last known good state, kept on durable storage so a cold boot can put the
+# last schedule back on screen before any network I/O
+STATE_PATH = os.path.join(CACHE_DIR, 'state.json')
+# Blob and mime type startDisplay last launched, recorded once the swap completes
+launchedMedia = {}
+serviceStartUptime = None
+firstFrameUptime = None
+FIRST_FRAME_TIMEOUT = 120
+
+# Player supervisor: notices a player exiting the moment it happens (pidfd) and
+# restarts it in place, and restarts or refreshes a player whose memory grows
+# past its budget or while the kernel reports sustained memory pressure.
+SUPERVISOR_INTERVAL = 30
+# RSS budget for the player process tree, default 60% of RAM
+PLAYER_MAX_RSS = int(os.environ.get('PISIGNAGE_PLAYER_MAX_RSS', psutil.virtual_memory().total * 0.6))
+# PSI 'full avg10' percentage that counts as thrashing, two checks in a row act on it
+MEMORY_PRESSURE_LIMIT = float(os.environ.get('PISIGNAGE_MEMORY_PRESSURE_LIMIT', 10))
+# Seconds between memory driven restarts, so a page that is simply big doesn't flap
+MEMORY_ACTION_INTERVAL = 600
+# Crashes within PLAYER_CRASH_WINDOW seconds after which restarts pause
+PLAYER_MAX_CRASHES = 5
+PLAYER_CRASH_WINDOW = 600
+# (controlFile, signageFile, contentHash) on screen, for restarting the player in place
+displayedContent = None
+playerHealth = {'restarts': 0, 'crashes': 0, 'refreshes': 0, 'rss': 0, 'rssPeak': 0,
+                'memoryPressurePeak': 0.0}
+
+# Two browser profiles used alternately, so the next page can start in its own
+# instance while the current one is still on screen
+BROWSER_PROFILES = [os.path.join(CACHE_DIR, 'profiles', slot) for slot in ('a', 'b')]
+BROWSER_USER_JS = """user_pref("browser.aboutwelcome.enabled", false);
+user_pref("browser.startup.homepage_override.mstone", "ignore");
+user_pref("datareporting.policy.firstRunURL", "");
+user_pref("browser.sessionstore.resume_from_crash", false);
+user_pref("media.autoplay.default", 0);
+"""
+browserProfileSlot = 0
+
+# One long-lived kiosk Firefox driven over Marionette. Pages are preloaded in a
+# background tab and swapped to in place; the browser is only restarted when it
+# stops answering. Falls back to a browser per change if Marionette won't connect.
+KIOSK_MARIONETTE = os.environ.get('PISIGNAGE_KIOSK_MARIONETTE', '1') == '1'
+MARIONETTE_PORT = int(os.environ.get('PISIGNAGE_MARIONETTE_PORT', 2828))
+KIOSK_PROFILE = os.path.join(CACHE_DIR, 'profiles', 'kiosk')
+# Seconds Firefox gets to open its Marionette port after a cold start
+KIOSK_START_TIMEOUT = 60
+# Seconds a navigation may take, page load included
+KIOSK_COMMAND_TIMEOUT = 60
+kioskBrowser = None
+kioskSocket = None
+kioskMessageId = 0
+# Handle of the tab on screen, and the background tab with its preloaded URL
+kioskTab = None
+kioskPreload = None
+kioskLock = threading.RLock()
+# Parked in the Sway scratchpad because nothing else covers it on screen
+kioskHidden = False
+# Audio and video play in one long-lived mpv controlled over its JSON IPC socket,
+# which loops without re-opening the file and swaps files without a new process.
+# 'ffplay' forces the previous process-per-change backend.
+VIDEO_PLAYER = os.environ.get('PISIGNAGE_VIDEO_PLAYER', 'mpv')
+MPV_SOCKET = os.path.join(CACHE_DIR, 'mpv.sock')
+# Seconds mpv gets to open its IPC socket after a cold start
+MPV_START_TIMEOUT = 15
+mpvPlayer = None
+mpvSocket = None
+mpvBuffer = b''
+mpvRequestId = 0
+mpvLock = threading.RLock()
+# mpv keeps its window closed (--force-window=no) while it plays audio only
+mpvAudioOnly = False
+# Lightweight Wayland image viewers tried for still images, before the browser
+IMAGE_VIEWERS = {
+    'swayimg': ['swayimg', '--fullscreen'],
+    'imv': ['imv', '-f'],
+}
+
+
+def _trace_request(request):
+    """Event hook that attaches an httpcore trace to the request, recording when each
+    phase of the exchange finishes so connect time can be told apart from transfer time.
+    """
+    events = {'start': time.monotonic()}
+    # API calls (and the push stream) are keyed by endpoint, content downloads share one entry
+    if request.method == 'GET' and request.headers.get('accept') != 'text/event-stream':
+        endpoint = 'download'
+    else:
+        endpoint = request.url.path.rsplit('/', 1)[-1]
+
+    def trace(eventName, info):
+        # e.g. 'connection.start_tls.complete' or 'http2.receive_response_body.complete'
+        events[eventName.split('.', 1)[-1]] = time.monotonic()
+        if eventName.endswith('response_closed.complete'):
+            httpTimings[endpoint] = _summarize_trace(events)
+
+    request.extensions['trace'] = trace
+
+def _summarize_trace(events):
+    def span(startEvent, endEvent):
+        if startEvent in events and endEvent in events:
+            return round((events[endEvent] - events[startEvent]) * 1000, 1)
+        return 0.0
+
+    return {
+        # Both stay 0 when a kept-alive connection was reused
+        'connectMs': span('connect_tcp.started', 'connect_tcp.complete'),
+        'tlsMs': span('start_tls.started', 'start_tls.complete'),
+        'waitMs': span('send_request_headers.started', 'receive_response_headers.complete'),
+        'transferMs': span('receive_response_body.started', 'receive_response_body.complete'),
+        'totalMs': span('start', 'response_closed.complete'),
+    }
+
+async def _trace_request_async(request):
+    """_trace_request for httpx.AsyncClient, whose transport awaits the trace callback"""
+    _trace_request(request)
+    trace = request.extensions['trace']
+
+    async def atrace(eventName, info):
+        trace(eventName, info)
+
+    request.extensions['trace'] = atrace
+
+def http_client_options(asynchronous=False, maxConnections=None):
+    """Settings shared by the pooled client and the push stream's async client, so
+    both negotiate HTTP/2, follow redirects and are traced the same way. Proxies and
+    CA bundles come from the environment (HTTPS_PROXY, SSL_CERT_FILE) for both.
+
+    Args:
+        asynchronous (bool): for an httpx.AsyncClient, which needs async event hooks
+        maxConnections (int): pool size, HTTP_MAX_CONNECTIONS if not given
+
+    Returns:
+        dict: keyword arguments for httpx.Client / httpx.AsyncClient
+    """
+    try:
+        import h2  # noqa: F401
+        http2 = HTTP2_ENABLED
+    except ImportError:
+        http2 = False
+    return {
+        'http2': http2,
+        'follow_redirects': True,
+        'limits': httpx.Limits(max_connections=maxConnections or HTTP_MAX_CONNECTIONS,
+                               max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                               keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+        'event_hooks': {'request': [_trace_request_async if asynchronous else _trace_request]},
+    }
+
+def get_http_client():
+    """Return the process-wide pooled HTTP client, creating it on first use"""
+    global httpClient
+    if httpClient is None:
+        httpClient = httpx.Client(**http_client_options())
+    return httpClient
+
+def get_download_client():
+    """Return the pooled client for content downloads and peer copies, creating it on
+    first use. Sized for a segmented on-screen download and a segmented prefetch at once.
+    """
+    global downloadClient
+    if downloadClient is None:
+        downloadClient = httpx.Client(**http_client_options(
+            maxConnections=max(HTTP_MAX_CONNECTIONS, 2 * DOWNLOAD_SEGMENTS)))
+    return downloadClient
+
+def _read_partial(partPath, url):
+    """Return (offset, md5, validator) for a resumable partial download of url, or a fresh start"""
+    md5 = hashlib.md5()
+    try:
+        with open(partPath + '.meta', 'r') as f:
+            meta = json.load(f)
+        if meta.get('url') != url or 'segments' in meta:
+            raise ValueError('partial belongs to another url or a segmented download')
+        with open(partPath, 'rb') as f:
+            while chunk := f.read(1024 * 1024):
+                md5.update(chunk)
+        return os.path.getsize(partPath), md5, meta.get('validator')
+    except (OSError, ValueError):
+        for stale in (partPath, partPath + '.meta'):
+            if os.path.exists(stale):
+                os.remove(stale)
+        return 0, hashlib.md5(), None
+
+class DownloadCancelled(Exception):
+    """Raised inside a download when a newer schedule superseded it"""
+
+class RateLimit:
+    """Token bucket shared by every download thread and segment"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes, cancel=None):
+        """Block until nbytes fit under the rate
+
+        Args:
+            nbytes (int): bytes just received
+            cancel (threading.Event, optional): set to stop waiting
+        """
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            # At most a second's worth of burst
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= nbytes
+            wait = -self.allowance / self.rate
+        while wait > 0:
+            if cancel is not None and cancel.is_set():
+                raise DownloadCancelled()
+            time.sleep(min(wait, 0.5))
+            wait -= 0.5
+
+downloadLimit = RateLimit(DOWNLOAD_MAX_RATE)
+prefetchLimit = RateLimit(PREFETCH_MAX_RATE)
+
+def full_speed_window():
+    """True inside the configured window where downloads run uncapped"""
+    if not DOWNLOAD_FULL_SPEED_HOURS:
+        return False
+    start, _, end = DOWNLOAD_FULL_SPEED_HOURS.partition('-')
+    return item_window({'start': start.strip(), 'end': end.strip()}, datetime.datetime.now())[0]
+
+def throttle(nbytes, bulk=False, cancel=None, lan=False):
+    """Hold a download back to the bandwidth ceiling that applies right now
+
+    Args:
+        nbytes (int): bytes just received
+        bulk (bool): background prefetch, which is also held to the prefetch ceiling
+        cancel (threading.Event, optional): set to stop waiting
+        lan (bool): copy from a LAN peer, the ceilings protect the uplink so it isn't held back
+    """
+    if lan:
+        return
+    if (DOWNLOAD_MAX_RATE or (bulk and PREFETCH_MAX_RATE)) and not full_speed_window():
+        downloadLimit.consume(nbytes, cancel)
+        if bulk:
+            prefetchLimit.consume(nbytes, cancel)
+
+def _download_segmented(url, partPath, cancel=None, bulk=False, lan=False):
+    """Fetch url into partPath as several concurrent byte ranges written in place.
+    Segment progress is kept in partPath.meta so an interrupted download resumes
+    each range where it stopped.
+
+    Returns:
+        int: size of the completed file, None when the server or file isn't suited
+        to segmenting (the caller falls back to a single stream)
+    """
+    metaPath = partPath + '.meta'
+    meta = None
+    try:
+        with open(metaPath, 'r') as f:
+            meta = json.load(f)
+        if meta.get('url') != url or 'segments' not in meta or not os.path.exists(partPath):
+            meta = None
+    except (OSError, ValueError):
+        pass
+    if meta is None:
+        if os.path.exists(partPath):
+            # A single stream partial, resume that instead
+            return None
+        # One byte probe: a 206 with the total size means ranges are supported
+        try:
+            with get_download_client().stream('GET', url, headers={'Range': 'bytes=0-0'}, timeout=30) as r:
+                if r.status_code != 206:
+                    return None
+                total = r.headers.get('content-range', '').rpartition('/')[2]
+                validator = r.headers.get('etag') or r.headers.get('last-modified')
+        except httpx.TransportError:
+            # The single stream path has its own retries
+            return None
+        if not total.isdigit() or int(total) < DOWNLOAD_SEGMENT_MIN_BYTES:
+            return None
+        total = int(total)
+        step = -(-total // DOWNLOAD_SEGMENTS)
+        # [next byte to fetch, last byte] per segment
+        meta = {'url': url, 'validator': validator, 'size': total,
+                'segments': [[start, min(start + step, total) - 1] for start in range(0, total, step)]}
+        with open(partPath, 'wb') as f:
+            f.truncate(total)
+    segments = meta['segments']
+    metaLock = threading.Lock()
+    abort = threading.Event()
+
+    def persist():
+        with metaLock, open(metaPath, 'w') as f:
+            json.dump(meta, f)
+
+    def fetch_segment(segment):
+        lastPersist = time.monotonic()
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            if segment[0] > segment[1]:
+                return
+            headers = {'Range': f'bytes={segment[0]}-{segment[1]}'}
+            if meta['validator']:
+                headers['If-Range'] = meta['validator']
+            try:
+                with get_download_client().stream('GET', url, headers=headers, timeout=30) as r:
+                    if r.status_code in (200, 416):
+                        # Whole body instead of our range (If-Range failed), or a range
+                        # past the end: the file changed under us
+                        raise ValueError(f"server answered {r.status_code} to a range request")
+                    if r.status_code == 429 or r.status_code >= 500:
+                        # Overloaded or briefly failing, retry this segment like a dropped connection
+                        raise httpx.TransportError(f"server answered {r.status_code}")
+                    r.raise_for_status()
+                    for chunk in r.iter_bytes():
+                        if abort.is_set() or (cancel is not None and cancel.is_set()):
+                            raise DownloadCancelled(url)
+                        chunk = chunk[:segment[1] - segment[0] + 1]
+                        os.pwrite(fd, chunk, segment[0])
+                        segment[0] += len(chunk)
+                        throttle(len(chunk), bulk, cancel, lan)
+                        if time.monotonic() - lastPersist > 2:
+                            persist()
+                            lastPersist = time.monotonic()
+                if segment[0] <= segment[1]:
+                    raise httpx.TransportError("range ended early")
+                return
+            except httpx.TransportError as e:
+                if attempt == DOWNLOAD_ATTEMPTS:
+                    raise
+                recentLogs(f"Download segment interrupted ({e}), resuming...")
+                time.sleep(2 * attempt)
+
+    persist()
+    fd = os.open(partPath, os.O_WRONLY)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(segments)) as pool:
+            futures = [pool.submit(fetch_segment, segment) for segment in segments]
+            for future in concurrent.futures.as_completed(futures):
+                if future.exception() is not None:
+                    # Stop the other segments, the first failure decides what happens
+                    abort.set()
+            errors = [future.exception() for future in futures if future.exception() is not None]
+    finally:
+        os.close(fd)
+    failure = next((e for e in errors if not isinstance(e, DownloadCancelled)), None)
+    if isinstance(failure, ValueError):
+        recentLogs(f"Segmented download of {url} restarting as a single stream: {failure}", level='warning')
+        for stale in (partPath, metaPath):
+            if os.path.exists(stale):
+                os.remove(stale)
+        return None
+    # Keep progress for a later resume
+    persist()
+    if failure is not None:
+        raise failure
+    if errors:
+        raise errors[0]
+    return meta['size']
+
+def _finish_download(url, partPath, dest, digest, expectedSize, expected_md5):
+    """Verify a completed partial and move it into place atomically"""
+    size = os.path.getsize(partPath)
+    if os.path.exists(partPath + '.meta'):
+        os.remove(partPath + '.meta')
+    if (expectedSize is not None and size != expectedSize) or \
+            (expected_md5 and digest != expected_md5):
+        os.remove(partPath)
+        raise ValueError(f"Download of {url} failed verification "
+                         f"({size} bytes, md5 {digest})")
+    os.replace(partPath, dest)
+    remember_checksum(dest, digest)
+    return digest
+
+def downloadFile(url, dest, expected_md5=None, cancel=None, bulk=False, lan=False):
     """Download a file from url to dest using a streaming request with a timeout.
     Avoids hanging indefinitely on flaky networks, and handles large files without
-    loading them fully into memory.
+    loading them fully into memory. The md5 is computed in the same pass as the
+    write so the file never needs to be read back just to be hashed.
+
+    Bytes land in a dest.part staging file, an interrupted transfer resumes with an
+    HTTP Range request instead of starting over, and dest is only replaced atomically
+    once the file is complete and verified, so a partial file is never played.
+    Large files are fetched as concurrent byte ranges instead, and hashed afterwards.
 
     Args:
         url (str): URL to download from
         dest (str): local file path to write to
+        expected_md5 (str, optional): md5 the server says the content should have
+        cancel (threading.Event, optional): set to abort, keeping the partial for a later resume
+        bulk (bool): background prefetch, held to the prefetch bandwidth ceiling
+        lan (bool): copy from a LAN peer, not held to any bandwidth ceiling
+
+    Returns:
+        str: md5 hex digest of the downloaded file
     """
-    with httpx.stream('GET', url, timeout=30, follow_redirects=True) as r:
-        r.raise_for_status()
-        with open(dest, 'wb') as f:
-            for chunk in r.iter_bytes():
-                f.write(chunk)
+    partPath = dest + '.part'
+    if DOWNLOAD_SEGMENTS > 1:
+        size = _download_segmented(url, partPath, cancel, bulk, lan)
+        if size is not None:
+            md5 = hashlib.md5()
+            with open(partPath, 'rb') as f:
+                while chunk := f.read(1024 * 1024):
+                    md5.update(chunk)
+            return _finish_download(url, partPath, dest, md5.hexdigest(), size, expected_md5)
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        offset, md5, validator = _read_partial(partPath, url)
+        headers = {}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+            if validator:
+                # Server sends the whole file instead if it changed since the partial started
+                headers['If-Range'] = validator
+        try:
+            with get_download_client().stream('GET', url, headers=headers, timeout=30) as r:
+                if r.status_code == 416:
+                    # Our partial is not a valid prefix any more, start from scratch
+                    os.remove(partPath)
+                    continue
+                r.raise_for_status()
+                if r.status_code != 206:
+                    offset, md5 = 0, hashlib.md5()
+                else:
+                    recentLogs(f"Resuming download at byte {offset}")
+                expectedSize = None
+                if 'content-range' in r.headers:
+                    total = r.headers['content-range'].rpartition('/')[2]
+                    expectedSize = int(total) if total.isdigit() else None
+                elif 'content-length' in r.headers and 'content-encoding' not in r.headers:
+                    expectedSize = int(r.headers['content-length'])
+                validator = r.headers.get('etag') or r.headers.get('last-modified')
+                with open(partPath + '.meta', 'w') as f:
+                    json.dump({'url': url, 'validator': validator}, f)
+                with open(partPath, 'ab' if offset else 'wb') as f:
+                    for chunk in r.iter_bytes():
+                        if cancel is not None and cancel.is_set():
+                            raise DownloadCancelled(url)
+                        f.write(chunk)
+                        md5.update(chunk)
+                        throttle(len(chunk), bulk, cancel, lan)
+        except httpx.TransportError as e:
+            if attempt == DOWNLOAD_ATTEMPTS:
+                raise
+            recentLogs(f"Download interrupted ({e}), resuming...")
+            time.sleep(2 * attempt)
+            continue
+
+        return _finish_download(url, partPath, dest, md5.hexdigest(), expectedSize, expected_md5)
+    raise httpx.TransportError(f"Download of {url} did not complete")
 
 def clearFiles():
-    """clears all temp files used for playback, ensures nothing is re-used"""
-    if os.path.exists('/tmp/signageFile'):
-        os.remove('/tmp/signageFile')
+    """clears all temp files used for playback, ensures nothing is re-used.
+    signageFile is only a link into the media cache, so cached blobs are kept.
+    """
+    if os.path.lexists(SIGNAGE_FILE):
+        os.remove(SIGNAGE_FILE)
         recentLogs("Clearing files...")
-    if os.path.exists('/tmp/controlFile.html'):
-        os.remove('/tmp/controlFile.html')
+    if os.path.exists(CONTROL_FILE):
+        os.remove(CONTROL_FILE)
+
+def load_media_index():
+    """Load the media cache index from disk, starting empty if missing or corrupt.
+
+    Returns:
+        dict: {'urls': {url: md5}, 'blobs': {md5: {'size': int, 'lastUsed': float}}}
+    """
+    global mediaIndex
+    with mediaIndexLock:
+        if mediaIndex is not None:
+            return mediaIndex
+        os.makedirs(MEDIA_CACHE_DIR, exist_ok=True)
+        try:
+            with open(MEDIA_INDEX_PATH, 'r') as f:
+                mediaIndex = json.load(f)
+            mediaIndex.setdefault('urls', {})
+            mediaIndex.setdefault('blobs', {})
+        except (OSError, ValueError):
+            mediaIndex = {'urls': {}, 'blobs': {}}
+        # Drop entries whose blob went missing from disk
+        for digest in list(mediaIndex['blobs']):
+            if not os.path.exists(os.path.join(MEDIA_CACHE_DIR, digest)):
+                del mediaIndex['blobs'][digest]
+        for url, digest in list(mediaIndex['urls'].items()):
+            if digest not in mediaIndex['blobs']:
+                del mediaIndex['urls'][url]
+        # Partial downloads nobody resumed within a week are not coming back
+        for name in os.listdir(MEDIA_CACHE_DIR):
+            path = os.path.join(MEDIA_CACHE_DIR, name)
+            if name.startswith('.download-') and time.time() - os.path.getmtime(path) > 7 * 86400:
+                os.remove(path)
+        return mediaIndex
+
+def save_media_index():
+    """Write the media cache index atomically so a crash never leaves it half written"""
+    tmpPath = MEDIA_INDEX_PATH + '.tmp'
+    try:
+        with mediaIndexLock, open(tmpPath, 'w') as f:
+            json.dump(mediaIndex, f)
+        os.replace(tmpPath, MEDIA_INDEX_PATH)
+    except OSError as e:
+        recentLogs(f"Failed to save media cache index: {e}")
+
+def evict_media(keep=()):
+    """Evict least recently used blobs until the cache fits in CACHE_MAX_BYTES.
+
+    Args:
+        keep (iterable): md5 digests that must not be evicted
+    """
+    with mediaIndexLock:
+        index = load_media_index()
+        keep = set(keep) | pinnedDigests
+        # Never pull the file that is currently on screen out from under the player
+        if os.path.lexists(SIGNAGE_FILE):
+            keep.add(os.path.basename(os.path.realpath(SIGNAGE_FILE)))
+        total = sum(blob['size'] + blob.get('renditionSize', 0) for blob in index['blobs'].values())
+        for digest, blob in sorted(index['blobs'].items(), key=lambda item: item[1].get('lastUsed', 0)):
+            if total <= CACHE_MAX_BYTES:
+                break
+            if digest in keep:
+                continue
+            # Transcoded renditions live next to the original and go with it
+            for path in [os.path.join(MEDIA_CACHE_DIR, digest)] + glob.glob(os.path.join(MEDIA_CACHE_DIR, digest + '.*')):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            checksumCache.pop(os.path.join(os.path.realpath(MEDIA_CACHE_DIR), digest), None)
+            if mediaMeta and mediaMeta.pop(digest, None) is not None:
+                _save_media_meta()
+            total -= blob['size'] + blob.get('renditionSize', 0)
+            del index['blobs'][digest]
+            for url in [u for u, d in index['urls'].items() if d == digest]:
+                del index['urls'][url]
+            recentLogs(f"Evicted {digest} from media cache")
+
+def fetch_media(url, expected_md5=None, cancel=None, bulk=False):
+    """Return the local path of the media at url, downloading it only on a cache miss.
+
+    Args:
+        url (str): URL of the content
+        expected_md5 (str, optional): md5 the server expects, also matches blobs cached under other URLs
+        cancel (threading.Event, optional): set to abort the download
+        bulk (bool): background prefetch, held to the prefetch bandwidth ceiling
+
+    Returns:
+        str: path to the cached blob
+    """
+    digest = cached_digest(url, expected_md5)
+    if digest is None:
+        # One download per URL at a time: a second caller (e.g. prefetch racing the
+        # display task) waits for the first and then finds the blob in the cache
+        lock = download_lock(url)
+        while not lock.acquire(timeout=0.5):
+            if cancel is not None and cancel.is_set():
+                raise DownloadCancelled(url)
+        try:
+            digest = cached_digest(url, expected_md5)
+            if digest is None:
+                # Staging name is per URL so an interrupted download resumes into the right file
+                stagingPath = os.path.join(MEDIA_CACHE_DIR, '.download-' + hashlib.md5(url.encode()).hexdigest())
+                if expected_md5 and fetch_from_peers(expected_md5, cancel):
+                    digest = expected_md5
+                    stagingPath = os.path.join(MEDIA_CACHE_DIR, '.download-peer-' + digest)
+                else:
+                    recentLogs("Downloading Signage File")
+                    digest = downloadFile(url, stagingPath, expected_md5=expected_md5, cancel=cancel, bulk=bulk)
+                with mediaIndexLock:
+                    os.replace(stagingPath, os.path.join(MEDIA_CACHE_DIR, digest))
+                    remember_checksum(os.path.join(MEDIA_CACHE_DIR, digest), digest)
+                    index = load_media_index()
+                    index['urls'][url] = digest
+                    # lastUsed is set here too, so a concurrent evict_media neither trips
+                    # over the entry nor picks it as the oldest blob
+                    index['blobs'][digest] = {'size': os.path.getsize(os.path.join(MEDIA_CACHE_DIR, digest)),
+                                              'lastUsed': time.time()}
+        finally:
+            lock.release()
+    else:
+        recentLogs("Signage File found in cache")
+    with mediaIndexLock:
+        index = load_media_index()
+        evicted = digest not in index['blobs']
+        if not evicted:
+            index['urls'][url] = digest
+            index['blobs'][digest]['lastUsed'] = time.time()
+            evict_media(keep=[digest])
+            save_media_index()
+    if evicted:
+        # Evicted by a concurrent fetch in the meantime, download it again
+        return fetch_media(url, expected_md5, cancel, bulk)
+    return os.path.join(MEDIA_CACHE_DIR, digest)
+
+def cached_digest(url, expected_md5=None):
+    """Return the digest of a cached blob for url, None on a cache miss"""
+    with mediaIndexLock:
+        index = load_media_index()
+        digest = index['urls'].get(url)
+        if expected_md5 and digest != expected_md5:
+            # Content behind the URL changed, or the same bytes are cached under another URL
+            digest = expected_md5 if expected_md5 in index['blobs'] else None
+        return digest
+
+def download_lock(key):
+    """Lock serialising downloads into the staging file for key (a URL or digest)"""
+    with mediaIndexLock:
+        return downloadLocks.setdefault(key, threading.Lock())
+
+def fetch_from_peers(digest, cancel=None):
+    """Try to copy a blob from a LAN peer that announced it
+
+    Args:
+        digest (str): md5 of the wanted content, the copy is verified against it
+        cancel (threading.Event, optional): set to abort the download
+
+    Returns:
+        bool: True if the blob is now in MEDIA_CACHE_DIR/.download-peer-<digest>
+    """
+    if not PEERS_ENABLED:
+        return False
+    holders = [peer for peer in list(peers.values()) if digest in peer['digests']]
+    # Spread a site-wide rollout across everyone who already has it
+    random.shuffle(holders)
+    for peer in holders:
+        ip = peer['ip']
+        url = f"http://{ip}:{peer['port']}/media/{digest}"
+        try:
+            # Quick liveness check so a peer that went away costs seconds, not retries
+            get_download_client().head(url, timeout=2).raise_for_status()
+            recentLogs(f"Downloading Signage File from peer {ip}")
+            with download_lock('peer:' + digest):
+                # LAN copies don't use the uplink the bandwidth ceilings are there to protect
+                downloadFile(url, os.path.join(MEDIA_CACHE_DIR, '.download-peer-' + digest),
+                             expected_md5=digest, cancel=cancel, lan=True)
+            peerStats['fromPeers'] += os.path.getsize(os.path.join(MEDIA_CACHE_DIR, '.download-peer-' + digest))
+            return True
+        except DownloadCancelled:
+            raise
+        except (httpx.HTTPError, OSError, ValueError) as e:
+            recentLogs(f"Peer {ip} could not supply {digest}: {e}", level='warning')
+            peer['digests'].discard(digest)
+    return False
+
+class PeerHandler(http.server.BaseHTTPRequestHandler):
+    """Serve cached blobs to LAN peers by digest, with Range support for resumes"""
+
+    def _blob(self):
+        name = self.path.split('?', 1)[0].rpartition('/media/')[2]
+        if not re.fullmatch(r'[0-9a-f]{32}', name) or name not in load_media_index()['blobs']:
+            self.send_error(404)
+            return None, 0
+        path = os.path.join(MEDIA_CACHE_DIR, name)
+        try:
+            return path, os.path.getsize(path)
+        except OSError:
+            self.send_error(404)
+            return None, 0
+
+    def do_HEAD(self):
+        path, size = self._blob()
+        if path:
+            self.send_response(200)
+            self.send_header('Content-Length', str(size))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', '"' + os.path.basename(path) + '"')
+            self.end_headers()
+
+    def do_GET(self):
+        path, size = self._blob()
+        if not path:
+            return
+        etag = '"' + os.path.basename(path) + '"'
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match and self.headers.get('If-Range', etag) == etag:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        with open(path, 'rb') as f:
+            self.connection.sendfile(f, start, end - start + 1)
+        peerStats['served'] += end - start + 1
+
+    def log_message(self, format, *args):
+        pass
+
+def start_peer_server():
+    """Serve the media cache to LAN peers from a background thread"""
+    global peerServer
+    peerServer = http.server.ThreadingHTTPServer(('0.0.0.0', PEER_HTTP_PORT), PeerHandler)
+    peerServer.daemon_threads = True
+    threading.Thread(target=peerServer.serve_forever, daemon=True).start()
+    recentLogs(f"Serving media cache to peers on port {peerServer.server_address[1]}")
+
+def peer_socket():
+    """UDP socket joined to the peer multicast group"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', PEER_ANNOUNCE_PORT))
+    membership = socket.inet_aton(PEER_GROUP) + socket.inet_aton('0.0.0.0')
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+    return sock
+
+def peer_announcement():
+    """This device's announcement: its HTTP port and most recently used digests"""
+    with mediaIndexLock:
+        blobs = list(load_media_index()['blobs'].items())
+    blobs.sort(key=lambda item: item[1].get('lastUsed', 0), reverse=True)
+    return json.dumps({'id': peerId, 'port': peerServer.server_address[1],
+                       'digests': [digest for digest, _ in blobs[:PEER_ANNOUNCE_MAX_DIGESTS]]}).encode()
+
+def listen_for_peers(sock):
+    """Record announcements from other devices, runs in its own thread"""
+    while True:
+        try:
+            data, (ip, _) = sock.recvfrom(65535)
+            announcement = json.loads(data)
+            if announcement.get('id') == peerId:
+                continue
+            peers[announcement['id']] = {'ip': ip, 'port': int(announcement['port']), 'digests': set(announcement['digests']),
+                         'seen': time.monotonic()}
+        except (ValueError, KeyError, TypeError):
+            continue
+        except OSError as e:
+            recentLogs(f"Peer listener stopped: {e}", level='warning')
+            return
+
+def link_signage_file(path):
+    """Point signageFile at a cached blob, swapping the link atomically.
+
+    Args:
+        path (str): path to the cached blob
+    """
+    tmpLink = SIGNAGE_FILE + '.tmp'
+    if os.path.lexists(tmpLink):
+        os.remove(tmpLink)
+    os.symlink(path, tmpLink)
+    os.replace(tmpLink, SIGNAGE_FILE)
+
+def _stat_key(fname):
+    st = os.stat(fname)
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def remember_checksum(fname, digest):
+    """Record a digest that is already known, e.g. one computed while downloading
+
+    Args:
+        fname (str): path to the file
+        digest (str): md5 hex digest of its current contents
+    """
+    checksumCache[os.path.realpath(fname)] = (_stat_key(fname), digest)
 
 def md5checksum(fname):
-    """checksum function to check media file being played back, sent to server to verify accuracy
+    """checksum function to check media file being played back, sent to server to verify accuracy.
+    Memoized against the file's inode, size and mtime so the heartbeat only re-hashes
+    when the file actually changed.
 
     Args:
         fname (str): path to file to checksum
@@ -138,14 +1114,31 @@ def md5checksum(fname):
     Returns:
         str?: checksum of the file
     """
-    md5 = hashlib.md5()
+    realPath = os.path.realpath(fname)
+    name = os.path.basename(realPath)
+    if os.path.dirname(realPath) == os.path.realpath(MEDIA_CACHE_DIR) and re.fullmatch(r'[0-9a-f]{32}', name):
+        # Cache blobs are named by their md5, verified when they were downloaded, so a
+        # fresh process (restoring a multi-GB video at boot) doesn't re-read the whole file
+        return name
+    key = _stat_key(realPath)
+    cached = checksumCache.get(realPath)
+    if cached and cached[0] == key:
+        return cached[1]
 
-    # Handle content in binary form
-    f = open(fname, "rb")
-    while chunk := f.read(4096):
-        md5.update(chunk)
+    md5 = hashlib.md5()
+    # Handle content in binary form, mapping the file lets hashlib walk it without copies
+    with open(realPath, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                md5.update(m)
+        except (ValueError, OSError):
+            # Empty files can't be mapped, fall back to large buffered reads
+            while chunk := f.read(1024 * 1024):
+                md5.update(chunk)
 
-    return md5.hexdigest()
+    digest = md5.hexdigest()
+    checksumCache[realPath] = (key, digest)
+    return digest
 
 def kill(proc_pid):
     """Used to stop running process by ID
@@ -159,32 +1152,412 @@ def kill(proc_pid):
     process.kill()
 
 # Define various pids
-def get_ffmpeg_version():
-    """Get FFmpeg version to determine codec compatibility"""
+def _boot_id():
+    return _read_first_line('/proc/sys/kernel/random/boot_id')
+
+def _probe_ffmpeg():
+    """Run ffmpeg to find its version, decoders and hwaccels"""
+    caps = {'version': 5, 'decoders': [], 'hwaccels': []}
     try:
-        result = subprocess.run(['ffmpeg', '-version'], 
+        result = subprocess.run(['ffmpeg', '-version'],
                               capture_output=True, text=True, timeout=5, check=False)
         version_line = result.stdout.split('\n')[0]
         # Extract version number (e.g., "ffmpeg version 7.1.2" -> "7.1.2")
         version_str = version_line.split()[2]
-        major_version = int(version_str.split('.')[0])
-        return major_version
+        caps['version'] = int(version_str.split('.')[0])
     except (subprocess.TimeoutExpired, IndexError, ValueError, OSError):
         recentLogs("Could not detect FFmpeg version, assuming v5 compatibility")
-        return 5
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-decoders'],
+                                capture_output=True, text=True, timeout=5, check=False)
+        # Lines look like " V....D h264_v4l2m2m  V4L2 mem2mem H.264 decoder wrapper"
+        for line in result.stdout.splitlines():
+            parts = line.split()
+            if len(parts) >= 2 and len(parts[0]) == 6 and parts[0][0] == 'V':
+                caps['decoders'].append(parts[1])
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-hwaccels'],
+                                capture_output=True, text=True, timeout=5, check=False)
+        caps['hwaccels'] = [line.strip() for line in result.stdout.splitlines()[1:] if line.strip()]
+    except (subprocess.TimeoutExpired, OSError):
+        recentLogs("Could not list FFmpeg decoders")
+    return caps
 
-def get_video_codec():
-    """Detect video codec of the file"""
+def get_ffmpeg_capabilities():
+    """Return ffmpeg's version, video decoders and hwaccels, probed once per boot.
+    The probe is cached on disk so service restarts within a boot skip it too.
+
+    Returns:
+        dict: {'version': int, 'decoders': [str], 'hwaccels': [str]}
+    """
+    global ffmpegCaps
+    if ffmpegCaps is not None:
+        return ffmpegCaps
+    bootId = _boot_id()
+    try:
+        with open(FFMPEG_CAPS_PATH, 'r') as f:
+            cached = json.load(f)
+        if cached.get('bootId') == bootId:
+            ffmpegCaps = cached
+            return ffmpegCaps
+    except (OSError, ValueError):
+        pass
+    ffmpegCaps = _probe_ffmpeg()
+    if not ffmpegCaps['decoders']:
+        # Failed probe, don't pin it for the rest of the boot
+        return ffmpegCaps
+    ffmpegCaps['bootId'] = bootId
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(FFMPEG_CAPS_PATH, 'w') as f:
+            json.dump(ffmpegCaps, f)
+    except OSError:
+        pass
+    return ffmpegCaps
+
+def get_ffmpeg_version():
+    """Get FFmpeg version to determine codec compatibility"""
+    return get_ffmpeg_capabilities()['version']
+
+def _save_media_meta():
+    tmpPath = MEDIA_META_PATH + '.tmp'
+    try:
+        with open(tmpPath, 'w') as f:
+            json.dump(mediaMeta, f)
+        os.replace(tmpPath, MEDIA_META_PATH)
+    except OSError as e:
+        recentLogs(f"Failed to save media metadata: {e}")
+
+def get_media_info(fname=SIGNAGE_FILE):
+    """Return codec, resolution, frame rate, duration and bitrate of a media file.
+    ffprobe only runs the first time a given content hash is seen, the result is
+    kept in a persistent index so relaunching a known asset skips probing.
+
+    Args:
+        fname (str): path to the media file
+
+    Returns:
+        dict: metadata, empty if ffprobe could not read the file
+    """
+    global mediaMeta
+    if mediaMeta is None:
+        try:
+            with open(MEDIA_META_PATH, 'r') as f:
+                mediaMeta = json.load(f)
+        except (OSError, ValueError):
+            mediaMeta = {}
+    digest = md5checksum(fname)
+    if digest in mediaMeta:
+        return mediaMeta[digest]
+
+    info = {}
     try:
         result = subprocess.run(['ffprobe', '-v', 'quiet', '-select_streams', 'v:0',
-                               '-show_entries', 'stream=codec_name', '-of', 
-                               'csv=p=0', '/tmp/signageFile'], 
-                              capture_output=True, text=True, timeout=5, check=False)
-        codec = result.stdout.strip()
-        return codec if codec else None
-    except (subprocess.TimeoutExpired, OSError):
+                                 '-show_entries',
+                                 'stream=codec_name,width,height,avg_frame_rate,bit_rate:format=duration,bit_rate',
+                                 '-of', 'json', fname],
+                                capture_output=True, text=True, timeout=5, check=False)
+        probe = json.loads(result.stdout or '{}')
+        stream = (probe.get('streams') or [{}])[0]
+        fmt = probe.get('format', {})
+        if stream.get('codec_name'):
+            info['codec'] = stream['codec_name']
+        if stream.get('width'):
+            info['width'] = stream['width']
+            info['height'] = stream['height']
+        num, _, den = stream.get('avg_frame_rate', '0/0').partition('/')
+        if num.isdigit() and den.isdigit() and int(den):
+            info['fps'] = round(int(num) / int(den), 3)
+        if fmt.get('duration'):
+            info['duration'] = float(fmt['duration'])
+        bitRate = stream.get('bit_rate') or fmt.get('bit_rate')
+        if bitRate:
+            info['bitRate'] = int(bitRate)
+    except (subprocess.TimeoutExpired, OSError, ValueError):
         recentLogs("Could not detect video codec, using default playback")
+        # Not cached, a later launch gets another try
+        return info
+    mediaMeta[digest] = info
+    _save_media_meta()
+    return info
+
+def get_video_codec(fname=SIGNAGE_FILE):
+    """Detect video codec of the file"""
+    return get_media_info(fname).get('codec')
+
+def _bench_clip(codec, width, height):
+    """Create (once) a short synthetic clip to benchmark decoding with"""
+    clipPath = os.path.join(BENCH_DIR, f'{codec}_{width}x{height}.mkv')
+    if os.path.exists(clipPath):
+        return clipPath
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    try:
+        result = subprocess.run(['nice', '-n', '19', 'ffmpeg', '-hide_banner', '-y',
+                                 '-f', 'lavfi', '-i', f'testsrc2=size={width}x{height}:rate=30',
+                                 '-frames:v', str(BENCH_FRAMES), '-c:v', BENCH_ENCODERS[codec],
+                                 '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', clipPath + '.tmp.mkv'],
+                                capture_output=True, timeout=600, check=False)
+    except (subprocess.TimeoutExpired, OSError) as e:
+        # e.g. a 4K software encode on a Pi, skip this size and keep the other results
+        recentLogs(f"Could not create {codec} {width}x{height} benchmark clip: {e}", level='warning')
+        result = None
+    if result is None or result.returncode != 0:
+        if os.path.exists(clipPath + '.tmp.mkv'):
+            os.remove(clipPath + '.tmp.mkv')
+        return None
+    os.replace(clipPath + '.tmp.mkv', clipPath)
+    return clipPath
+
+def _bench_decoder(clipPath, decoder):
+    """Decode clipPath as fast as possible and return the achieved frame rate, 0 on failure"""
+    if decoder == 'vaapi':
+        decodeArgs = ['-hwaccel', 'vaapi', '-hwaccel_output_format', 'vaapi']
+    else:
+        decodeArgs = ['-c:v', decoder]
+    start = time.monotonic()
+    try:
+        result = subprocess.run(['nice', '-n', '19', 'ffmpeg', '-hide_banner', '-nostats', '-benchmark']
+                                + decodeArgs + ['-i', clipPath, '-f', 'null', '-'],
+                                capture_output=True, text=True, timeout=300, check=False)
+    except (subprocess.TimeoutExpired, OSError):
+        return 0.0
+    elapsed = time.monotonic() - start
+    if result.returncode != 0:
+        return 0.0
+    # "bench: utime=1.2s stime=0.1s rtime=0.9s" excludes process start-up
+    match = re.search(r'rtime=([\d.]+)s', result.stderr)
+    if match and float(match.group(1)) > 0:
+        elapsed = float(match.group(1))
+    return round(BENCH_FRAMES / elapsed, 1)
+
+def run_decode_benchmark():
+    """Benchmark every available decoder against representative codecs and
+    resolutions, and save the measured frame rates as the decode profile.
+    Runs niced so it can share the device with playback.
+
+    Returns:
+        dict: the decode profile, None if nothing could be measured
+    """
+    global decodeProfile
+    caps = get_ffmpeg_capabilities()
+    recentLogs("Running decode benchmark...")
+    results = {}
+    for codec in BENCH_ENCODERS:
+        decoders = [d for d in (f'{codec}_v4l2m2m', codec) if d in caps['decoders']]
+        if 'vaapi' in caps['hwaccels']:
+            decoders.append('vaapi')
+        for width, height in BENCH_RESOLUTIONS:
+            clipPath = _bench_clip(codec, width, height)
+            if clipPath is None:
+                continue
+            fpsByDecoder = {decoder: _bench_decoder(clipPath, decoder) for decoder in decoders}
+            results.setdefault(codec, {})[f'{width}x{height}'] = fpsByDecoder
+            recentLogs(f"Decode benchmark {codec} {width}x{height}: {fpsByDecoder}")
+    if not results:
+        recentLogs("Decode benchmark could not run, keeping the default video rules", level='warning')
+        return None
+    decodeProfile = {
+        'ffmpegVersion': caps['version'],
+        'device': DEVICE_MODEL,
+        'results': results,
+    }
+    with open(DECODE_PROFILE_PATH, 'w') as f:
+        json.dump(decodeProfile, f)
+    return decodeProfile
+
+def load_decode_profile():
+    """Return the saved decode profile, or None if it is missing or was measured
+    with a different ffmpeg or on different hardware.
+    """
+    global decodeProfile
+    if decodeProfile is None:
+        try:
+            with open(DECODE_PROFILE_PATH, 'r') as f:
+                decodeProfile = json.load(f)
+        except (OSError, ValueError):
+            return None
+    if decodeProfile.get('ffmpegVersion') != get_ffmpeg_version() or \
+            decodeProfile.get('device') != DEVICE_MODEL:
         return None
+    return decodeProfile
+
+def choose_decoder(info):
+    """Pick the decoder for a video from the measured decode profile.
+
+    Args:
+        info (dict): media metadata from get_media_info
+
+    Returns:
+        str or None: ffmpeg decoder name (or 'vaapi', which only mpv can use), hardware
+        preferred, None if nothing measured keeps up with the stream. Returns the codec
+        itself when it was not benchmarked.
+    """
+    profile = load_decode_profile()
+    codec = info.get('codec')
+    if profile is None or codec not in profile['results']:
+        return codec
+    pixels = info.get('width', 1920) * info.get('height', 1080)
+    needFps = info.get('fps') or 30
+    measured = profile['results'][codec]
+    # Smallest benchmarked resolution that covers the video, scaled down if it's bigger than all
+    sizes = sorted(measured, key=lambda size: int(size.split('x')[0]) * int(size.split('x')[1]))
+    size = next((sz for sz in sizes if int(sz.split('x')[0]) * int(sz.split('x')[1]) >= pixels), sizes[-1])
+    scale = min(1.0, int(size.split('x')[0]) * int(size.split('x')[1]) / pixels)
+
+    def sustains(decoder):
+        return measured[size].get(decoder, 0) * scale >= needFps * DECODE_HEADROOM
+
+    # VA-API goes through mpv's hwdec, ffplay can only take a named decoder
+    candidates = [f'{codec}_v4l2m2m', 'vaapi', codec] if mpv_available() else [f'{codec}_v4l2m2m', codec]
+    for decoder in candidates:
+        if sustains(decoder):
+            return decoder
+    if sustains('vaapi'):
+        # The GPU could keep up but ffplay can't drive it: play in software rather than refuse
+        return codec
+    return None
+
+def video_playable(mediaPath):
+    """Decide whether this device can play a video, from the measured decode profile
+    when the codec was measured, otherwise from the conservative arch/RAM rule.
+    """
+    profile = load_decode_profile()
+    info = get_media_info(mediaPath) if profile else {}
+    if profile and info.get('codec') in profile['results']:
+        if choose_decoder(info) is None:
+            recentLogs(f"Skipping video: no decoder sustains {info.get('codec')} "
+                       f"{info.get('width')}x{info.get('height')}@{info.get('fps')}. Showing fallback image.")
+            return False
+        return True
+
+    arch = platform.machine()
+    # 3.8GB in bytes to account for system reserved memory on 4GB modules
+    min_ram = 3.8 * 1024 * 1024 * 1024
+    ram = psutil.virtual_memory().total
+
+    if arch != 'x86_64' or ram < min_ram:
+        recentLogs(f"Skipping video: Arch={arch}, RAM={ram/(1024**3):.1f}GB. Need x86_64 & 4GB+. Showing fallback image.")
+        return False
+    return True
+
+def display_size():
+    """Return (width, height) of the first connected display's preferred mode"""
+    match = re.search(r'(\d+)x(\d+)', getScreenResolution())
+    if match:
+        return int(match.group(1)), int(match.group(2))
+    return 1920, 1080
+
+def find_rendition(digest):
+    """Return the path of a finished rendition of a cached blob for this display, if any"""
+    width, height = display_size()
+    for path in glob.glob(os.path.join(MEDIA_CACHE_DIR, f'{digest}.{width}x{height}.*.mkv')):
+        return path
+    return None
+
+def _hardware_target(width, height):
+    """Pick the codec whose hardware decoder handled the display's resolution best"""
+    profile = load_decode_profile()
+    best, bestFps = 'h264', 0
+    for codec in ('h264', 'hevc'):
+        measured = (profile or {}).get('results', {}).get(codec, {})
+        # Closest benchmarked size at or above the display
+        for size, fpsByDecoder in measured.items():
+            w, h = (int(v) for v in size.split('x'))
+            if w * h >= width * height and fpsByDecoder.get(f'{codec}_v4l2m2m', 0) > bestFps:
+                best, bestFps = codec, fpsByDecoder[f'{codec}_v4l2m2m']
+    return best
+
+def needs_rendition(mediaPath):
+    """True when transcoding is on and the decode profile says no decoder on this
+    device keeps up with the video's codec at its resolution and frame rate, or
+    the codec was never benchmarked
+    """
+    profile = load_decode_profile()
+    if not TRANSCODE_ENABLED or profile is None:
+        return False
+    info = get_media_info(mediaPath)
+    codec = info.get('codec')
+    if codec is None:
+        return False
+    if codec not in profile['results']:
+        return True
+    return choose_decoder(info) is None
+
+def queue_transcode(digest):
+    """Add a cached blob to the background transcode queue, once"""
+    if digest not in transcodeQueue:
+        transcodeQueue.append(digest)
+        recentLogs(f"Queued {digest} for background transcoding")
+
+def _cpu_pressure():
+    """Return PSI 'some avg10' CPU pressure, falling back to load per core"""
+    line = _read_first_line('/proc/pressure/cpu')
+    if line:
+        match = re.search(r'avg10=([\d.]+)', line)
+        if match:
+            return float(match.group(1))
+    return 100.0 * float(getLoadAverages().split()[0]) / (os.cpu_count() or 1) - 100.0
+
+async def transcode_loop():
+    """Work through the transcode queue one job at a time while the device is idle"""
+    while True:
+        await asyncio.sleep(TRANSCODE_CHECK_INTERVAL)
+        if not transcodeQueue or _cpu_pressure() > TRANSCODE_MAX_CPU_PRESSURE:
+            continue
+        digest = transcodeQueue[0]
+        try:
+            await transcode(digest)
+        except Exception as e:
+            recentLogs(f"Transcoding {digest} failed: {e}", level='warning')
+        transcodeQueue.popleft()
+
+async def transcode(digest):
+    """Transcode one cached blob into a rendition fitted to the display"""
+    source = os.path.join(MEDIA_CACHE_DIR, digest)
+    if not os.path.exists(source) or find_rendition(digest):
+        return
+    width, height = display_size()
+    codec = _hardware_target(width, height)
+    info = await asyncio.to_thread(get_media_info, source)
+    target = os.path.join(MEDIA_CACHE_DIR, f'{digest}.{width}x{height}.{codec}.mkv')
+    filters = [f'scale=w={width}:h={height}:force_original_aspect_ratio=decrease',
+               'scale=trunc(iw/2)*2:trunc(ih/2)*2']
+    if (info.get('fps') or 0) > 30:
+        filters.append('fps=30')
+    recentLogs(f"Transcoding {digest} to {codec} {width}x{height}")
+    proc = subprocess.Popen(['nice', '-n', '19', 'ionice', '-c', '3',
+                             'ffmpeg', '-hide_banner', '-nostats', '-y', '-i', source,
+                             '-vf', ','.join(filters),
+                             '-c:v', 'libx264' if codec == 'h264' else 'libx265',
+                             '-preset', 'medium', '-crf', '23', '-pix_fmt', 'yuv420p',
+                             '-threads', '1', '-c:a', 'copy', target + '.tmp.mkv'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    paused = False
+    try:
+        while proc.poll() is None:
+            await asyncio.sleep(TRANSCODE_CHECK_INTERVAL)
+            pressure = _cpu_pressure()
+            # Step aside completely while anything else wants the CPU
+            if not paused and pressure > TRANSCODE_MAX_CPU_PRESSURE:
+                psutil.Process(proc.pid).suspend()
+                paused = True
+            elif paused and pressure <= TRANSCODE_MAX_CPU_PRESSURE:
+                psutil.Process(proc.pid).resume()
+                paused = False
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+    if proc.returncode != 0:
+        if os.path.exists(target + '.tmp.mkv'):
+            os.remove(target + '.tmp.mkv')
+        raise RuntimeError(f"ffmpeg exited with {proc.returncode}")
+    os.replace(target + '.tmp.mkv', target)
+    with mediaIndexLock:
+        index = load_media_index()
+        if digest in index['blobs']:
+            index['blobs'][digest]['renditionSize'] = os.path.getsize(target)
+            save_media_index()
+    recentLogs(f"Rendition of {digest} ready for the next play")
 
 def get_usb_audio_card():
     """Detect the first USB audio card number from /proc/asound/cards.
@@ -206,35 +1579,225 @@ def get_usb_audio_card():
         pass
     return None
 
-def avPID(is_audio=False):
+def video_decoder(path=SIGNAGE_FILE):
+    """Pick the video decoder to force for a file
+
+    Args:
+        path (str): media file
+
+    Returns:
+        str: ffmpeg decoder name, None to let the player use its software default
+    """
     ffmpeg_version = get_ffmpeg_version()
-    video_codec = get_video_codec()
-    
-    # Base ffplay command — audio-only files don't need a display
-    if is_audio:
-        cmd = ["ffplay", "-i", "/tmp/signageFile", "-loop", "0", "-nodisp"]
-    else:
-        cmd = ["ffplay", "-i", "/tmp/signageFile", "-loop", "0", "-fs", "-fast"]
-    
+    video_codec = get_video_codec(path)
+
+    decoder = choose_decoder(get_media_info(path)) if load_decode_profile() and video_codec else None
+    if decoder and decoder != video_codec:
+        # Measured decode profile says this hardware decoder keeps up with the stream
+        recentLogs(f"Using {decoder} hardware decoding from the decode benchmark")
+        return decoder
+    elif decoder:
+        recentLogs(f"Decode benchmark favours software decoding for {video_codec}")
     # For FFmpeg v7+, add hardware decoding if available
-    if ffmpeg_version >= 7 and video_codec:
+    elif ffmpeg_version >= 7 and video_codec:
         if video_codec in ['h264']:
             # Use V4L2 M2M hardware decoder for H.264
-            cmd.insert(1, "-c:v")
-            cmd.insert(2, "h264_v4l2m2m")
             recentLogs(f"Using H.264 hardware decoding for FFmpeg v{ffmpeg_version}")
+            return "h264_v4l2m2m"
         elif video_codec in ['hevc', 'h265']:
             # Use V4L2 M2M hardware decoder for H.265/HEVC
-            cmd.insert(1, "-c:v")
-            cmd.insert(2, "hevc_v4l2m2m")
             recentLogs(f"Using H.265/HEVC hardware decoding for FFmpeg v{ffmpeg_version}")
+            return "hevc_v4l2m2m"
         else:
             recentLogs(f"No hardware decoder available for codec {video_codec}, using software decoding")
     elif ffmpeg_version >= 7:
         recentLogs(f"FFmpeg v{ffmpeg_version} detected, but codec detection failed - using software decoding")
     else:
         recentLogs(f"FFmpeg v{ffmpeg_version} detected, using compatible software decoding")
-    
+    return None
+
+def avPID(is_audio=False, path=SIGNAGE_FILE):
+    decoder = None if is_audio else video_decoder(path)
+    pid = mpv_play(path, is_audio, decoder)
+    if pid:
+        return pid
+
+    # Base ffplay command — audio-only files don't need a display
+    if is_audio:
+        cmd = ["ffplay", "-i", path, "-loop", "0", "-nodisp"]
+    else:
+        cmd = ["ffplay", "-i", path, "-loop", "0", "-fs", "-fast"]
+    if decoder and decoder != 'vaapi':
+        cmd.insert(1, "-c:v")
+        cmd.insert(2, decoder)
+
+    pid = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT, env=player_env())
+    recentLogs("Launching ffmpeg for audio/video file.")
+    return pid
+
+def mpv_command(*command):
+    """Run one command on the mpv JSON IPC socket
+
+    Args:
+        command: the command and its arguments, e.g. ('get_property', 'time-pos')
+
+    Returns:
+        the command's data field, None if it has none
+    """
+    global mpvRequestId, mpvBuffer
+    mpvRequestId += 1
+    request = {'command': list(command), 'request_id': mpvRequestId}
+    mpvSocket.sendall(json.dumps(request).encode() + b'\n')
+    while True:
+        while b'\n' not in mpvBuffer:
+            chunk = mpvSocket.recv(65536)
+            if not chunk:
+                raise ConnectionError("mpv closed its IPC socket")
+            mpvBuffer += chunk
+        line, mpvBuffer = mpvBuffer.split(b'\n', 1)
+        reply = json.loads(line)
+        # Events are interleaved with replies, only our reply matters
+        if reply.get('request_id') == mpvRequestId:
+            break
+    if reply.get('error') != 'success':
+        raise RuntimeError(f"mpv {command[0]} failed: {reply.get('error')}")
+    return reply.get('data')
+
+def mpv_start():
+    """Start the long-lived mpv and connect to its IPC socket"""
+    global mpvPlayer, mpvSocket, mpvBuffer
+    mpv_stop()
+    if os.path.exists(MPV_SOCKET):
+        os.remove(MPV_SOCKET)
+    cmd = ['mpv', '--idle=yes', '--force-window=no', '--fullscreen', '--loop-file=inf',
+           '--no-osc', '--no-osd-bar', '--osd-level=0', '--no-input-default-bindings',
+           '--no-terminal', f'--input-ipc-server={MPV_SOCKET}']
+    usb_card = get_usb_audio_card()
+    if usb_card is not None:
+        cmd.append(f'--audio-device=alsa/hw:{usb_card},0')
+        recentLogs(f"USB audio device detected on card {usb_card}, routing audio to hw:{usb_card},0")
+    mpvPlayer = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + MPV_START_TIMEOUT
+    while True:
+        try:
+            mpvSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            mpvSocket.settimeout(10)
+            mpvSocket.connect(MPV_SOCKET)
+            break
+        except OSError:
+            mpvSocket.close()
+            mpvSocket = None
+            if time.monotonic() > deadline or mpvPlayer.poll() is not None:
+                raise
+            time.sleep(0.2)
+    mpvBuffer = b''
+    recentLogs("mpv started.")
+
+def mpv_stop():
+    """Tear mpv down, e.g. because it stopped responding"""
+    global mpvPlayer, mpvSocket
+    if mpvSocket is not None:
+        mpvSocket.close()
+        mpvSocket = None
+    if mpvPlayer is not None:
+        try:
+            kill(mpvPlayer.pid)
+        except psutil.NoSuchProcess:
+            pass
+        mpvPlayer = None
+
+def mpv_healthy():
+    """True if mpv is running and answering on its socket"""
+    if mpvPlayer is None or mpvPlayer.poll() is not None or mpvSocket is None:
+        return False
+    try:
+        mpv_command('get_property', 'idle-active')
+        return True
+    except (OSError, ValueError, RuntimeError):
+        return False
+
+def mpv_available():
+    """True when mpv is the configured video player and is installed"""
+    return VIDEO_PLAYER == 'mpv' and shutil.which('mpv') is not None
+
+def mpv_play(path, is_audio=False, decoder=None):
+    """Swap a file into the long-lived mpv, starting it if needed. mpv loops the
+    file in place, so there is no re-open hiccup at the loop point.
+
+    Args:
+        path (str): media file
+        is_audio (bool): audio only, keep the window closed
+        decoder (str): ffmpeg video decoder to force, 'vaapi' for VA-API hwdec, None for the software default
+
+    Returns:
+        Popen or None: the mpv process, None if mpv is unavailable
+    """
+    global mpvAudioOnly
+    if not mpv_available():
+        return None
+    with mpvLock:
+        try:
+            if not mpv_healthy():
+                mpv_start()
+            # Options set through options/ stick for the next loadfile
+            mpv_command('set_property', 'options/vid', 'no' if is_audio else 'auto')
+            if decoder == 'vaapi':
+                mpv_command('set_property', 'options/hwdec', 'vaapi')
+                mpv_command('set_property', 'options/vd', '')
+            else:
+                mpv_command('set_property', 'options/hwdec', 'no')
+                mpv_command('set_property', 'options/vd', decoder or '')
+            mpv_command('loadfile', path, 'replace')
+            mpv_command('set_property', 'pause', False)
+            mpvAudioOnly = is_audio
+        except (OSError, ValueError, RuntimeError) as e:
+            recentLogs(f"mpv unavailable ({e}), launching ffplay instead.", level='warning')
+            mpv_stop()
+            return None
+    if not is_audio:
+        focus_window(mpvPlayer.pid)
+    recentLogs("Playing audio/video file in mpv.")
+    return mpvPlayer
+
+def mpv_idle():
+    """Stop playback but keep mpv running for the next file"""
+    with mpvLock:
+        if mpv_healthy():
+            try:
+                mpv_command('stop')
+            except (OSError, ValueError, RuntimeError):
+                mpv_stop()
+
+def player_stats():
+    """Playback statistics from mpv for the heartbeat
+
+    Returns:
+        dict: position, duration, fps and dropped frame counters, None when mpv isn't playing
+    """
+    if browserPID is None or browserPID is not mpvPlayer:
+        return None
+    with mpvLock:
+        if not mpv_healthy():
+            return None
+        stats = {}
+        for key, prop in (('position', 'time-pos'), ('duration', 'duration'),
+                          ('fps', 'estimated-vf-fps'),
+                          # frames dropped by the output vs. by a decoder that fell behind
+                          ('droppedFrames', 'frame-drop-count'),
+                          ('decoderDroppedFrames', 'decoder-frame-drop-count'),
+                          ('hwdec', 'hwdec-current')):
+            try:
+                value = mpv_command('get_property', prop)
+            except RuntimeError:
+                # Unavailable right now, e.g. no video track
+                continue
+            except (OSError, ValueError):
+                return None
+            stats[key] = round(value, 2) if isinstance(value, float) else value
+    return stats
+
+def player_env():
+    """Environment for ffplay, routed to a USB audio device when one is present"""
     # Dynamically select USB audio output if one is present
     env = os.environ.copy()
     usb_card = get_usb_audio_card()
@@ -244,70 +1807,377 @@ def avPID(is_audio=False):
         recentLogs(f"USB audio device detected on card {usb_card}, routing audio to hw:{usb_card},0")
     else:
         recentLogs("No USB audio device found, using default audio output")
+    return env
 
-    pid = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT, env=env)
-    recentLogs("Launching ffmpeg for audio/video file.")
-    return pid
+def browserCommand():
+    """Build the kiosk browser command on the next free profile.
+    --new-instance keeps it from handing the URL to the browser already on screen.
+    """
+    global browserProfileSlot
+    browserProfileSlot = (browserProfileSlot + 1) % len(BROWSER_PROFILES)
+    profile = BROWSER_PROFILES[browserProfileSlot]
+    os.makedirs(profile, exist_ok=True)
+    with open(os.path.join(profile, 'user.js'), 'w') as f:
+        f.write(BROWSER_USER_JS)
+    return [browser, browser_flags, '--new-instance', '--profile', profile, SIGNAGE_FILE]
 
 def linkPID():
-    pid = subprocess.Popen([browser,
-                            browser_flags,
-                            "/tmp/signageFile"],
+    pid = kiosk_show() or subprocess.Popen(browserCommand(),
                             stdout=subprocess.DEVNULL,
                             stderr=subprocess.STDOUT)
     recentLogs("Webpage detected. Launching Firefox.")
     return pid
 
 def imagePID():
-    pid = subprocess.Popen([browser,
-                            browser_flags,
-                            "/tmp/signageFile"],
+    # A native viewer starts in a fraction of the time and memory of a browser
+    for viewer, command in IMAGE_VIEWERS.items():
+        if shutil.which(viewer):
+            pid = subprocess.Popen(command + [os.path.realpath(SIGNAGE_FILE)],
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.STDOUT)
+            recentLogs(f"Image detected. Launching {viewer}.")
+            return pid
+    pid = kiosk_show() or subprocess.Popen(browserCommand(),
                             stdout=subprocess.DEVNULL,
                             stderr=subprocess.STDOUT)
     recentLogs("Image detected. Launching Firefox.")
     return pid
 
 def otherFilePID():
-    pid = subprocess.Popen([browser,
-                            browser_flags,
-                            "/tmp/signageFile"],
+    pid = kiosk_show() or subprocess.Popen(browserCommand(),
                             stdout=subprocess.DEVNULL,
                             stderr=subprocess.STDOUT)
     recentLogs("Undetermined file type. Attempting to launch in Firefox.")
     return pid
 
-def startDisplay(controlFile, signageFile):
+def _marionette_recv():
+    """Read one length-prefixed Marionette packet ("<length>:<json>")"""
+    header = b''
+    while not header.endswith(b':'):
+        byte = kioskSocket.recv(1)
+        if not byte:
+            raise ConnectionError("Marionette closed the connection")
+        header += byte
+    length = int(header[:-1])
+    body = b''
+    while len(body) < length:
+        chunk = kioskSocket.recv(length - len(body))
+        if not chunk:
+            raise ConnectionError("Marionette closed the connection")
+        body += chunk
+    return json.loads(body)
+
+def marionette(command, params=None):
+    """Send a WebDriver command to the kiosk browser and return its result
+
+    Args:
+        command (str): e.g. 'WebDriver:Navigate'
+        params (dict): command parameters
+
+    Returns:
+        dict: the command's result value
+    """
+    global kioskMessageId
+    kioskMessageId += 1
+    data = json.dumps([0, kioskMessageId, command, params or {}]).encode()
+    kioskSocket.sendall(str(len(data)).encode() + b':' + data)
+    while True:
+        _, messageId, error, result = _marionette_recv()
+        if messageId == kioskMessageId:
+            break
+    if error:
+        raise RuntimeError(f"{command} failed: {error.get('message', error)}")
+    return result
+
+def kiosk_start():
+    """Start the long-lived kiosk browser and open a Marionette session with it"""
+    global kioskBrowser, kioskSocket, kioskTab, kioskPreload
+    kiosk_stop()
+    os.makedirs(KIOSK_PROFILE, exist_ok=True)
+    with open(os.path.join(KIOSK_PROFILE, 'user.js'), 'w') as f:
+        f.write(BROWSER_USER_JS + f'user_pref("marionette.port", {MARIONETTE_PORT});\n')
+    kioskBrowser = subprocess.Popen([browser, browser_flags, '--marionette', '--new-instance',
+                                     '--profile', KIOSK_PROFILE, 'about:blank'],
+                                    stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + KIOSK_START_TIMEOUT
+    while True:
+        try:
+            kioskSocket = socket.create_connection(('127.0.0.1', MARIONETTE_PORT), timeout=5)
+            break
+        except OSError:
+            if time.monotonic() > deadline or kioskBrowser.poll() is not None:
+                raise
+            time.sleep(0.5)
+    kioskSocket.settimeout(KIOSK_COMMAND_TIMEOUT)
+    # Server hello, then a session with the default (wait for load) page load strategy
+    _marionette_recv()
+    marionette('WebDriver:NewSession')
+    kioskTab = marionette('WebDriver:GetWindowHandle')['value']
+    kioskPreload = None
+    recentLogs("Kiosk browser started.")
+
+def kiosk_stop():
+    """Tear the kiosk browser down, e.g. because it stopped responding"""
+    global kioskBrowser, kioskSocket, kioskHidden
+    kioskHidden = False
+    if kioskSocket is not None:
+        kioskSocket.close()
+        kioskSocket = None
+    if kioskBrowser is not None:
+        try:
+            kill(kioskBrowser.pid)
+        except psutil.NoSuchProcess:
+            pass
+        kioskBrowser = None
+
+def kiosk_healthy():
+    """True if the kiosk browser is running and answers a cheap command quickly"""
+    if kioskBrowser is None or kioskBrowser.poll() is not None or kioskSocket is None:
+        return False
+    try:
+        kioskSocket.settimeout(5)
+        marionette('WebDriver:GetWindowHandles')
+        return True
+    except (OSError, ValueError, RuntimeError):
+        return False
+    finally:
+        if kioskSocket is not None:
+            kioskSocket.settimeout(KIOSK_COMMAND_TIMEOUT)
+
+def _kiosk_switch(handle, focus):
+    marionette('WebDriver:SwitchToWindow', {'handle': handle, 'focus': focus})
+
+def kiosk_preload(url):
+    """Load url in a background tab so a later kiosk_show(url) is an instant tab switch"""
+    global kioskPreload
+    with kioskLock:
+        if not KIOSK_MARIONETTE or (kioskPreload and kioskPreload[1] == url):
+            return
+        try:
+            if not kiosk_healthy():
+                kiosk_start()
+            if kioskPreload:
+                _kiosk_switch(kioskPreload[0], False)
+                marionette('WebDriver:CloseWindow')
+            handle = marionette('WebDriver:NewWindow', {'type': 'tab', 'focus': False})['handle']
+            _kiosk_switch(handle, False)
+            marionette('WebDriver:Navigate', {'url': url})
+            kioskPreload = (handle, url)
+            _kiosk_switch(kioskTab, True)
+        except (OSError, ValueError, RuntimeError) as e:
+            recentLogs(f"Kiosk preload failed: {e}", level='warning')
+            kioskPreload = None
+
+def kiosk_show(url=None):
+    """Show url (the current signageFile by default) in the kiosk browser without
+    restarting it, preloading into a background tab and swapping to it once loaded.
+
+    Returns:
+        Popen or None: the kiosk browser process, None if Marionette is unavailable
+    """
+    global kioskTab, kioskPreload, kioskHidden
+    if not KIOSK_MARIONETTE:
+        return None
+    url = url or 'file://' + os.path.realpath(SIGNAGE_FILE)
+    with kioskLock:
+        try:
+            if not kiosk_healthy():
+                kiosk_start()
+            if kioskPreload and kioskPreload[1] == url:
+                handle = kioskPreload[0]
+            else:
+                if kioskPreload:
+                    _kiosk_switch(kioskPreload[0], False)
+                    marionette('WebDriver:CloseWindow')
+                handle = marionette('WebDriver:NewWindow', {'type': 'tab', 'focus': False})['handle']
+                _kiosk_switch(handle, False)
+                marionette('WebDriver:Navigate', {'url': url})
+            kioskPreload = None
+            # Bring the loaded tab forward, then drop the one that was on screen
+            _kiosk_switch(handle, True)
+            if kioskTab != handle:
+                _kiosk_switch(kioskTab, False)
+                marionette('WebDriver:CloseWindow')
+                _kiosk_switch(handle, True)
+            kioskTab = handle
+        except (OSError, ValueError, RuntimeError) as e:
+            recentLogs(f"Kiosk browser unavailable ({e}), launching a separate instance.", level='warning')
+            kiosk_stop()
+            return None
+    if kioskHidden:
+        # Back out of the scratchpad as the fullscreen tiled window it was
+        sway_command(f'[pid={kioskBrowser.pid}] scratchpad show, floating disable, fullscreen enable')
+        kioskHidden = False
+    # Raise the browser above whatever player is still fullscreen
+    focus_window(kioskBrowser.pid)
+    return kioskBrowser
+
+def focus_window(pid):
+    """Raise a long-lived player's window above whatever is still fullscreen"""
+    sway_command(f'[pid={pid}] focus')
+
+def kiosk_refresh():
+    """Reload the page on screen in the kiosk browser"""
+    with kioskLock:
+        if kiosk_healthy():
+            try:
+                marionette('WebDriver:Refresh')
+            except (OSError, ValueError, RuntimeError):
+                kiosk_stop()
+
+def kiosk_blank():
+    """Park the kiosk browser on a blank page so it holds little memory while hidden"""
+    with kioskLock:
+        if kiosk_healthy():
+            try:
+                marionette('WebDriver:Navigate', {'url': 'about:blank'})
+            except (OSError, ValueError, RuntimeError):
+                kiosk_stop()
+
+def kiosk_hide():
+    """Take the parked kiosk browser out of sight when nothing else covers it (DEFAULT,
+    audio only), so a blank page doesn't replace the desktop. It goes to the Sway
+    scratchpad, or is closed without Sway.
+    """
+    global kioskHidden
+    with kioskLock:
+        if kioskBrowser is None or kioskHidden:
+            return
+        if sway_command(f'[pid={kioskBrowser.pid}] move scratchpad'):
+            kioskHidden = True
+        else:
+            kiosk_stop()
+
+def stop_player(proc):
+    """Take a player off screen. The kiosk browser and mpv are parked rather than
+    killed so the next item doesn't pay for a cold start.
+
+    Args:
+        proc (Popen): the player process
+    """
+    if proc is kioskBrowser:
+        kiosk_blank()
+    elif proc is mpvPlayer:
+        mpv_idle()
+    else:
+        kill(proc.pid)
+
+def get_window_pids():
+    """Return the pids that own a visible window in the Sway tree, or None without Sway"""
+    tree = sway_request(SWAY_GET_TREE)
+    if tree is None:
+        try:
+            result = subprocess.run(['swaymsg', '-t', 'get_tree', '-r'],
+                                    capture_output=True, text=True, timeout=5, check=True)
+            tree = json.loads(result.stdout)
+        except (subprocess.SubprocessError, OSError, ValueError):
+            return None
+    pids = set()
+    nodes = [tree]
+    while nodes:
+        node = nodes.pop()
+        if node.get('pid') and node.get('visible'):
+            pids.add(node['pid'])
+        nodes.extend(node.get('nodes', []))
+        nodes.extend(node.get('floating_nodes', []))
+    return pids
+
+def player_windowless(proc):
+    """True for an audio-only player, which never maps a window to wait for"""
+    if proc is mpvPlayer:
+        return mpvAudioOnly
+    return '-nodisp' in proc.args
+
+def wait_until_rendering(proc, timeout=PLAYER_READY_TIMEOUT):
+    """Block until a freshly launched player is actually on screen, so the previous
+    player can be killed without the bare desktop showing in between.
+
+    Args:
+        proc (Popen): the new player process
+        timeout (int): seconds to wait before giving up
+
+    Returns:
+        bool: True if the player was confirmed rendering
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            return False
+        windowPids = get_window_pids()
+        if windowPids is None or player_windowless(proc):
+            # No compositor to ask, or an audio-only player: a short grace period will do
+            time.sleep(1)
+            return proc.poll() is None
+        try:
+            ownPids = {proc.pid} | {child.pid for child in psutil.Process(proc.pid).children(recursive=True)}
+        except psutil.NoSuchProcess:
+            return False
+        if windowPids & ownPids:
+            return True
+        time.sleep(0.1)
+    recentLogs("New player did not show a window in time, switching anyway.")
+    return False
+
+def startDisplay(controlFile, signageFile, contentHash=None, cancel=None):
     """Starts firefox running the media content passed by signageFile
     and run using controlFile
 
     Args:
         controlFile (str): path to file that controls how media is played
         signageFile (str): path to media file
+        contentHash (str, optional): md5 the server expects the media file to have
+        cancel (threading.Event, optional): set when a newer schedule supersedes this one
 
     Returns:
         PID: process object from spawning firefox
     """
-    recentLogs("Downloading Signage File")
-    downloadFile(signageFile, '/tmp/signageFile')
+    mediaPath = fetch_media(signageFile, expected_md5=contentHash, cancel=cancel)
     if not controlFile == '':
         recentLogs("Downloading Control File.")
-        downloadFile(controlFile, '/tmp/controlFile.html')
+        downloadFile(controlFile, CONTROL_FILE, cancel=cancel)
+    elif os.path.exists(CONTROL_FILE):
+        os.remove(CONTROL_FILE)
+    # Last point where a superseded schedule can back out without touching the screen
+    if cancel is not None and cancel.is_set():
+        raise DownloadCancelled(signageFile)
+    link_signage_file(mediaPath)
     try:
+        # Sniff the cached blob itself, magic reports the signageFile link as a symlink
         fileType = magic.from_file(
-            '/tmp/signageFile', mime=True)
+            mediaPath, mime=True)
         # recentLogs(f"File type '{fileType}' detected.") # For Debugging
+    except Exception as e:
+        recentLogs(f"Could not access signageFile: {e}", level='error')
+        return None
+    launchedMedia.update(digest=os.path.basename(mediaPath), fileType=fileType)
+    return launchPlayer(mediaPath, fileType, controlFile)
 
+def launchPlayer(mediaPath, fileType, controlFile=''):
+    """Start the right player for a cached blob that signageFile already points at
+
+    Args:
+        mediaPath (str): path to the cached blob
+        fileType (str): mime type of the blob
+        controlFile (str): path to file that controls how media is played, if any
+
+    Returns:
+        PID: process object of the player, None if it could not be started
+    """
+    try:
         # Probably a video or audio file
         if 'video' in fileType or 'audio' in fileType:
             if 'video' in fileType:
-                arch = platform.machine()
-                # 3.8GB in bytes to account for system reserved memory on 4GB modules
-                min_ram = 3.8 * 1024 * 1024 * 1024
-                ram = psutil.virtual_memory().total
-                
-                if arch != 'x86_64' or ram < min_ram:
-                    recentLogs(f"Skipping video: Arch={arch}, RAM={ram/(1024**3):.1f}GB. Need x86_64 & 4GB+. Showing fallback image.")
-                    downloadFile('https://piman.sagebrush.work/pi_manager_api/media/Content_69eab3397e544073d0feeaae.jpg', '/tmp/signageFile')
+                digest = os.path.basename(mediaPath)
+                rendition = find_rendition(digest)
+                if rendition:
+                    # signageFile keeps pointing at the original so the reported hash is unchanged
+                    recentLogs("Playing pre-transcoded rendition.")
+                    return avPID(path=rendition)
+                if needs_rendition(mediaPath):
+                    queue_transcode(digest)
+                if not video_playable(mediaPath):
+                    link_signage_file(fetch_media(FALLBACK_IMAGE_URL))
                     pid = imagePID()
                     return pid
             pid = avPID(is_audio='audio' in fileType and 'video' not in fileType)
@@ -331,69 +2201,317 @@ def startDisplay(controlFile, signageFile):
         return pid
 
     except Exception as e:
-        recentLogs(f"Could not access signageFile: {e}")
+        recentLogs(f"Could not access signageFile: {e}", level='error')
         return None
 
-def recentLogs(logMessage: str):
-    """keeps track of the previous 50 debug messages for sending to server
+def load_logs():
+    """Restore the log ring buffer and the acknowledged sequence number from disk.
+    Called with logLock held.
+    """
+    global logSequence, logAckSequence, logLinesOnDisk, logsLoaded
+    logsLoaded = True
+    try:
+        with open(LOG_PATH, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn write from a crash, skip it
+                    continue
+                logBuffer.append(entry)
+                logLinesOnDisk += 1
+    except OSError:
+        pass
+    try:
+        with open(LOG_ACK_PATH, 'r') as f:
+            logAckSequence = int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        pass
+    # Never reuse a sequence number piman already acknowledged, even if the log file was lost
+    logSequence = max(logBuffer[-1]['seq'] if logBuffer else 0, logAckSequence)
+
+def _persist_log(entry):
+    """Append an entry to the on-disk log, compacting it to the ring buffer once it
+    has grown to twice the buffer size. Called with logLock held.
+    """
+    global logLinesOnDisk
+    try:
+        if logLinesOnDisk >= 2 * LOG_BUFFER_SIZE:
+            tmpPath = LOG_PATH + '.tmp'
+            with open(tmpPath, 'w') as f:
+                f.writelines(json.dumps(e) + '\n' for e in logBuffer)
+            os.replace(tmpPath, LOG_PATH)
+            logLinesOnDisk = len(logBuffer)
+        else:
+            with open(LOG_PATH, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+            logLinesOnDisk += 1
+    except OSError:
+        # Logging must never take the client down, the entry is still in memory
+        pass
+
+def recentLogs(logMessage: str, level='info', **fields):
+    """Records a debug message in the durable log buffer for sending to server
 
     Args:
         logMessage (str): the log message
+        level (str): severity, e.g. 'info', 'warning' or 'error'
+        **fields: structured context attached to the entry
 
     Returns:
-        list: list of log messages
+        dict: the log entry
     """
-    if len(logList) > 50:
-        logList.pop(0)
-    logList.append(str(datetime.datetime.now().strftime(
-        "%Y-%m-%d %H:%M:%S")) + ' - ' + logMessage)
+    global logSequence
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with logLock:
+        if not logsLoaded:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            load_logs()
+        logSequence += 1
+        entry = {'seq': logSequence, 'time': timestamp, 'level': level, 'msg': logMessage}
+        if fields:
+            entry['fields'] = fields
+        logBuffer.append(entry)
+        _persist_log(entry)
 
     # Print to pi console for debugging
-    print(str(datetime.datetime.now().strftime(
-        "%Y-%m-%d %H:%M:%S")) + ' - ' + logMessage)
-    return logList
+    print(timestamp + ' - ' + logMessage)
+    return entry
+
+def legacy_log_lines():
+    """Return the most recent log lines formatted for the piLogs field"""
+    with logLock:
+        entries = list(logBuffer)[-LEGACY_LOG_LINES:]
+    return [f"{e['time']} - {e['msg']}" for e in entries]
+
+def unacked_log_entries():
+    """Return the oldest batch of entries piman has not acknowledged yet"""
+    with logLock:
+        return [e for e in logBuffer if e['seq'] > logAckSequence][:LOG_BATCH_SIZE]
+
+def acknowledge_logs(sequence):
+    """Record that piman holds every entry up to sequence, surviving restarts
+
+    Args:
+        sequence (int): highest acknowledged sequence number
+    """
+    global logAckSequence
+    if sequence <= logAckSequence:
+        return
+    logAckSequence = sequence
+    try:
+        with open(LOG_ACK_PATH, 'w') as f:
+            f.write(str(sequence))
+    except OSError:
+        pass
+
+def load_commands():
+    """Load the ids of commands already run, and results still to acknowledge"""
+    global executedCommands, commandAcks, legacyCommand
+    with commandsLock:
+        if executedCommands is not None:
+            return
+        try:
+            with open(COMMANDS_PATH, 'r') as f:
+                saved = json.load(f)
+            executedCommands = collections.OrderedDict(saved.get('executed', []))
+            commandAcks = saved.get('acks', [])
+            legacyCommand = saved.get('legacy')
+        except (OSError, ValueError):
+            executedCommands = collections.OrderedDict()
+
+def save_commands():
+    """Persist command history with fsync, before anything like a reboot can happen"""
+    with commandsLock:
+        while len(executedCommands) > COMMAND_HISTORY:
+            executedCommands.popitem(last=False)
+        tmpPath = COMMANDS_PATH + '.tmp'
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(tmpPath, 'w') as f:
+                json.dump({'executed': list(executedCommands.items()), 'acks': commandAcks,
+                           'legacy': legacyCommand}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpPath, COMMANDS_PATH)
+        except OSError as e:
+            recentLogs(f"Failed to save command history: {e}", level='warning')
+
+def run_command(commandId, commandFlags, commandFile=''):
+    """Run a command unless its id already ran, recording the result for acknowledgement
+
+    Args:
+        commandId (str): unique id of this command
+        commandFlags (str): the command, e.g. 'RotateLandscape'
+        commandFile (str): command script path, if any
+    """
+    load_commands()
+    with commandsLock:
+        if commandId in executedCommands:
+            return
+        recentLogs(f"Command {commandId}: {commandFlags}")
+        # Recorded (with legacyCommand) before it runs: a reboot or service restart
+        # never gets to the after, and must not run the same command again
+        ack = {'id': commandId, 'command': commandFlags,
+               'result': 'ok' if commandFlags in ("Restart", "RestartProcess") else 'started',
+               'time': time.time()}
+        executedCommands[commandId] = ack['result']
+        commandAcks.append(ack)
+        save_commands()
+    try:
+        result = execute_command(commandFlags, commandFile)
+    except Exception as e:
+        recentLogs(f"Command {commandId} failed: {e}", level='error')
+        result = 'failed'
+    with commandsLock:
+        executedCommands[commandId] = result
+        if ack in commandAcks:
+            ack.update(result=result, time=time.time())
+        else:
+            # piman already confirmed the 'started' entry, report the outcome separately
+            commandAcks.append({**ack, 'result': result, 'time': time.time()})
+        save_commands()
+
+def dispatch_command(commandId, commandFlags, commandFile=''):
+    """Hand a command to the command worker thread, see run_command"""
+    commandExecutor.submit(run_command, commandId, commandFlags, commandFile)
+
+def acknowledge_commands(ids):
+    """Drop results piman confirmed it received
+
+    Args:
+        ids (iterable): acknowledged command ids
+    """
+    global commandAcks
+    ids = set(ids)
+    with commandsLock:
+        if any(ack['id'] in ids for ack in commandAcks):
+            commandAcks = [ack for ack in commandAcks if ack['id'] not in ids]
+            save_commands()
+
+def execute_command(commandFlags, commandFile=''):
+    """Carry out one command
+
+    Args:
+        commandFlags (str): the command, e.g. 'RotateLandscape'
+        commandFile (str): command script path, if any
+
+    Returns:
+        str: 'ok', 'failed' or 'unknown'
+    """
+    if commandFlags == "Restart":
+        recentLogs("Rebooting...")
+        return 'ok' if os.system("sudo reboot") == 0 else 'failed'
+    elif commandFlags == "RestartProcess":
+        recentLogs("Restarting piman service...")
+        return 'ok' if os.system("systemctl --user restart piman.service") == 0 else 'failed'
+    elif commandFlags == "RotatePortraitLeft":
+        recentLogs("Rotating screen portrait left (270)...")
+        if sway_command("output * transform 270"):
+            set_sway_transform(270)
+            return 'ok'
+        return 'failed'
+    elif commandFlags == "RotatePortraitRight":
+        recentLogs("Rotating screen portrait right (90)...")
+        if sway_command("output * transform 90"):
+            set_sway_transform(90)
+            return 'ok'
+        return 'failed'
+    elif commandFlags == "RotateLandscape":
+        recentLogs("Rotating screen landscape (0)...")
+        if sway_command("output * transform 0"):
+            set_sway_transform(0)
+            return 'ok'
+        return 'failed'
+    elif re.fullmatch(r'SetMode\d+x\d+(@[\d.]+Hz)?', commandFlags):
+        mode = commandFlags[len("SetMode"):]
+        recentLogs(f"Setting display mode {mode}...")
+        if sway_command(f"output * mode {mode}"):
+            set_sway_output('mode', mode)
+            return 'ok'
+        return 'failed'
+    elif commandFlags in ("DisplayOff", "DisplayOn"):
+        state = commandFlags[len("Display"):].lower()
+        recentLogs(f"Turning display {state}...")
+        # 'power' replaced 'dpms' in newer Sway releases
+        if sway_command(f"output * power {state}") or sway_command(f"output * dpms {state}"):
+            return 'ok'
+        return 'failed'
+    # TV commands are queued to the CEC worker, the result is the TV state it reports
+    elif commandFlags == "TurnOnTV":
+        tv_command('on')
+        return 'ok'
+    elif commandFlags == "TurnOffTV":
+        tv_command('standby')
+        return 'ok'
+    elif commandFlags.startswith("TVInput"):
+        tv_command('input', commandFlags[len("TVInput"):])
+        return 'ok'
+    elif commandFlags == "TVStatus":
+        tv_command('status')
+        return 'ok'
+    recentLogs(f"Unknown command {commandFlags}", level='warning')
+    return 'unknown'
 
 def getIP():
-    ipAddressInfo = subprocess.run(
-        ['hostname',
-         '-I'],
-         stdout=subprocess.PIPE,
-         check=True)
-    ipAddress = ipAddressInfo.stdout.decode()
+    """lists the host's addresses like `hostname -I`, read in-process instead of forking"""
+    ipv4, ipv6 = [], []
+    for addrs in psutil.net_if_addrs().values():
+        for addr in addrs:
+            if addr.family == socket.AF_INET and not addr.address.startswith('127.'):
+                ipv4.append(addr.address)
+            elif addr.family == socket.AF_INET6 and addr.address != '::1' \
+                    and not addr.address.lower().startswith('fe80'):
+                ipv6.append(addr.address.split('%')[0])
+    ipAddress = ' '.join(ipv4 + ipv6) + ' \n'
 
     return ipAddress
 
 def getScreenResolution():
-    resolution = subprocess.run(['/home/pi/pi-signage-pi-client/resolution.sh'],
-        stdout=subprocess.PIPE).stdout.decode('utf-8')
+    """Python port of resolution.sh: each connected DRM connector followed by its
+    preferred mode, e.g. '/sys/class/drm/card1-HDMI-A-1 1920x1080 '
 
-    resolution = resolution.replace('\n', ' ')
+    Under Sway the outputs kept current by IPC output events are used instead,
+    with each output's current mode.
+    """
+    if swayOutputs is not None or sway_connect():
+        lines = []
+        for output in swayOutputs or []:
+            mode = output.get('current_mode')
+            if output.get('active') and mode:
+                connectors = glob.glob(f"/sys/class/drm/card*-{output['name']}")
+                lines.append(connectors[0] if connectors else output['name'])
+                lines.append(f"{mode['width']}x{mode['height']}")
+        return ''.join(line + ' ' for line in lines)
+
+    lines = []
+    for connector in sorted(glob.glob('/sys/class/drm/card*-*')):
+        try:
+            with open(os.path.join(connector, 'modes'), 'r') as f:
+                modes = f.read()
+        except OSError:
+            continue
+        if modes:
+            lines.append(connector)
+            lines.append(modes.splitlines()[0])
+
+    resolution = ''.join(line + ' ' for line in lines)
 
     return resolution
 
 def getLoadAverages():
     """gets the load averages from /proc/loadavg"""
 
-    loadAvgFull = subprocess.run([
-        'cat',
-        '/proc/loadavg',
-        ], stdout=subprocess.PIPE,
-    )
-
-    loadAvg = loadAvgFull.stdout.decode()
+    with open('/proc/loadavg', 'r') as f:
+        loadAvg = f.read()
 
     return loadAvg
 
 def getUptime():
     """gets the uptime from /proc/uptime and returns a human-readable string"""
 
-    uptimeFull = subprocess.run([
-        'cat',
-        '/proc/uptime',
-    ], stdout=subprocess.PIPE,
-    )
-
-    uptime_seconds = float(uptimeFull.stdout.decode().split()[0])
+    with open('/proc/uptime', 'r') as f:
+        uptime_seconds = float(f.read().split()[0])
 
     days = int(uptime_seconds // 86400)
     hours = int((uptime_seconds % 86400) // 3600)
@@ -409,21 +2527,153 @@ def getUptime():
 
     return ", ".join(parts)
 
+def _read_cpu_times():
+    """Return (busy, total) jiffies from the aggregate cpu line of /proc/stat"""
+    with open('/proc/stat', 'r') as f:
+        values = [int(v) for v in f.readline().split()[1:]]
+    # idle + iowait count as idle time
+    idle = values[3] + (values[4] if len(values) > 4 else 0)
+    total = sum(values[:8])
+    return total - idle, total
+
+def _read_net_bytes():
+    """Return total (rx, tx) bytes over all non-loopback interfaces from /proc/net/dev"""
+    rx = tx = 0
+    with open('/proc/net/dev', 'r') as f:
+        for line in f.readlines()[2:]:
+            name, _, counters = line.partition(':')
+            if name.strip() == 'lo':
+                continue
+            fields = counters.split()
+            rx += int(fields[0])
+            tx += int(fields[8])
+    return rx, tx
+
+def _read_first_line(path):
+    try:
+        with open(path, 'r') as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+def sample_metrics(previous):
+    """Take one metrics sample straight from /proc and /sys, no processes spawned
+
+    Args:
+        previous (dict or None): the last sample, rates are computed against it
+
+    Returns:
+        dict: the sample, with private counters used by the next call
+    """
+    now = time.monotonic()
+    busy, total = _read_cpu_times()
+    rx, tx = _read_net_bytes()
+    meminfo = {}
+    with open('/proc/meminfo', 'r') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            meminfo[key] = int(value.split()[0]) * 1024
+    sample = {
+        'time': time.time(),
+        'load1': float(getLoadAverages().split()[0]),
+        'memUsedPct': round(100 * (1 - meminfo['MemAvailable'] / meminfo['MemTotal']), 1),
+        '_cpu': (busy, total),
+        '_net': (rx, tx),
+        '_mono': now,
+    }
+    if previous is not None:
+        elapsed = now - previous['_mono']
+        busyDelta = busy - previous['_cpu'][0]
+        totalDelta = total - previous['_cpu'][1]
+        sample['cpuPct'] = round(100 * busyDelta / totalDelta, 1) if totalDelta else 0.0
+        sample['rxBps'] = round((rx - previous['_net'][0]) / elapsed) if elapsed else 0
+        sample['txBps'] = round((tx - previous['_net'][1]) / elapsed) if elapsed else 0
+    temp = _read_first_line(SOC_TEMP_PATH)
+    if temp:
+        sample['socTempC'] = round(int(temp) / 1000, 1)
+    throttled = _read_first_line(THROTTLED_PATH)
+    if throttled:
+        sample['throttled'] = int(throttled, 16)
+    try:
+        st = os.statvfs(CACHE_DIR)
+        sample['diskFreeBytes'] = st.f_bavail * st.f_frsize
+    except OSError:
+        pass
+    return sample
+
+async def metrics_loop():
+    """Sample system metrics on a fixed interval into the in-memory time series"""
+    previous = None
+    while True:
+        try:
+            previous = sample_metrics(previous)
+            metricsHistory.append(previous)
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            recentLogs(f"Metrics sample failed: {e}", level='warning')
+        await asyncio.sleep(METRICS_SAMPLE_INTERVAL)
+
+def summarize_metrics(since):
+    """Downsample the samples taken after since into one summary for the heartbeat
+
+    Args:
+        since (float): wall clock time of the previous summary
+
+    Returns:
+        dict: averages and peaks over the window, latest values for gauges
+    """
+    samples = [m for m in metricsHistory if m['time'] > since and 'cpuPct' in m]
+    if not samples:
+        return {}
+    latest = samples[-1]
+    summary = {'samples': len(samples)}
+    for key in ('cpuPct', 'memUsedPct', 'load1', 'socTempC', 'rxBps', 'txBps'):
+        values = [m[key] for m in samples if key in m]
+        if values:
+            summary[key] = {'avg': round(sum(values) / len(values), 1), 'max': max(values)}
+    if 'throttled' in latest:
+        # Bits that were set at any point in the window
+        flags = 0
+        for m in samples:
+            flags |= m.get('throttled', 0)
+        summary['throttled'] = hex(flags)
+    if 'diskFreeBytes' in latest:
+        summary['diskFreeBytes'] = latest['diskFreeBytes']
+    return summary
+
 SWAY_CONFIG_PATH = os.path.expanduser("~/.config/sway/config")
+# Sway IPC message types, and the output event (events have the high bit set)
+SWAY_RUN_COMMAND = 0
+SWAY_SUBSCRIBE = 2
+SWAY_GET_OUTPUTS = 3
+SWAY_GET_TREE = 4
+SWAY_EVENT_OUTPUT = 0x80000001
+SWAY_IPC_MAGIC = b'i3-ipc'
+# One persistent IPC connection: a reader thread hands replies back to callers in
+# order and refreshes the cached outputs whenever Sway announces an output change
+swaySocket = None
+swayLock = threading.Lock()
+swayConnectLock = threading.Lock()
+# Reply slots in request order, a queue.Queue per waiting caller or None
+swayPending = collections.deque()
+swayOutputs = None
 
 def set_sway_transform(value):
-    """Persist an output transform in the Sway config file so it survives reboots.
+    """Persist an output transform in the Sway config file so it survives reboots."""
+    set_sway_output('transform', value)
 
-    Replaces any existing 'output * transform' line, or appends one if absent.
+def set_sway_output(setting, value):
+    """Persist an output setting in the Sway config file so it survives reboots.
+
+    Replaces any existing 'output * <setting>' line, or appends one if absent.
     """
-    line = f"output * transform {value}\n"
-    pattern = re.compile(r"^\s*output\s+\*\s+transform\s+\S+.*$", re.MULTILINE)
+    line = f"output * {setting} {value}\n"
+    pattern = re.compile(rf"^\s*output\s+\*\s+{setting}\s+\S+.*$", re.MULTILINE)
     try:
         if os.path.exists(SWAY_CONFIG_PATH):
             with open(SWAY_CONFIG_PATH, "r") as f:
                 contents = f.read()
             if pattern.search(contents):
-                contents = pattern.sub(f"output * transform {value}", contents)
+                contents = pattern.sub(f"output * {setting} {value}", contents)
             else:
                 contents += line
         else:
@@ -434,196 +2684,1111 @@ def set_sway_transform(value):
     except OSError as e:
         recentLogs(f"Failed to update sway config: {e}")
 
+def sway_socket_path():
+    """Sway's IPC socket from SWAYSOCK, or found in the runtime directory"""
+    if os.environ.get('SWAYSOCK'):
+        return os.environ['SWAYSOCK']
+    runtimeDir = os.environ.get('XDG_RUNTIME_DIR', f'/run/user/{os.getuid()}')
+    sockets = glob.glob(os.path.join(runtimeDir, 'sway-ipc.*.sock'))
+    return sockets[0] if sockets else None
+
+def _sway_send(sock, messageType, payload=b''):
+    sock.sendall(SWAY_IPC_MAGIC + struct.pack('=II', len(payload), messageType) + payload)
+
+def _sway_recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Sway closed the IPC socket")
+        data += chunk
+    return data
+
+def sway_reader(sock):
+    """Read replies and events off the IPC connection until it closes"""
+    global swaySocket, swayOutputs
+    try:
+        while True:
+            header = _sway_recv_exact(sock, len(SWAY_IPC_MAGIC) + 8)
+            length, messageType = struct.unpack('=II', header[len(SWAY_IPC_MAGIC):])
+            payload = json.loads(_sway_recv_exact(sock, length))
+            if messageType == SWAY_EVENT_OUTPUT:
+                # The event carries no details, ask for the outputs again
+                with swayLock:
+                    swayPending.append(None)
+                    _sway_send(sock, SWAY_GET_OUTPUTS)
+                continue
+            if messageType & 0x80000000:
+                continue
+            with swayLock:
+                slot = swayPending.popleft() if swayPending else None
+            if messageType == SWAY_GET_OUTPUTS:
+                if slot is None and swayOutputs is not None and payload != swayOutputs:
+                    swayOutputs = payload
+                    recentLogs(f"Display outputs changed: {getScreenResolution().strip() or 'none'}")
+                swayOutputs = payload
+            if slot is not None:
+                slot.put(payload)
+    except (OSError, ValueError) as e:
+        recentLogs(f"Sway IPC connection lost: {e}", level='warning')
+    with swayLock:
+        if swaySocket is sock:
+            swaySocket = None
+            swayOutputs = None
+        for slot in swayPending:
+            if slot is not None:
+                slot.put(None)
+        swayPending.clear()
+    sock.close()
+
+def sway_connect():
+    """Open the IPC connection and subscribe to output events, if Sway is running
+
+    Returns:
+        bool: True if connected
+    """
+    global swaySocket
+    with swayConnectLock:
+        if swaySocket is not None:
+            return True
+        path = sway_socket_path()
+        if path is None:
+            return False
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+        except OSError:
+            return False
+        swaySocket = sock
+        threading.Thread(target=sway_reader, args=(sock,), daemon=True).start()
+        if sway_request(SWAY_SUBSCRIBE, json.dumps(['output'])) is None:
+            return False
+        sway_request(SWAY_GET_OUTPUTS)
+    recentLogs("Connected to Sway IPC.")
+    return True
+
+def sway_request(messageType, payload=''):
+    """Send one IPC message and wait for its reply
+
+    Args:
+        messageType (int): e.g. SWAY_RUN_COMMAND
+        payload (str): message body
 
-def main():
+    Returns:
+        the decoded reply, None if Sway isn't reachable
+    """
+    if swaySocket is None and (messageType == SWAY_SUBSCRIBE or not sway_connect()):
+        return None
+    slot = queue.Queue()
+    with swayLock:
+        if swaySocket is None:
+            return None
+        try:
+            swayPending.append(slot)
+            _sway_send(swaySocket, messageType, payload.encode())
+        except OSError:
+            swayPending.pop()
+            return None
+    try:
+        return slot.get(timeout=5)
+    except queue.Empty:
+        return None
+
+def sway_command(command):
+    """Run a Sway command over IPC, falling back to swaymsg without a connection
+
+    Args:
+        command (str): e.g. 'output * transform 90'
+
+    Returns:
+        bool: True if Sway ran it successfully
+    """
+    reply = sway_request(SWAY_RUN_COMMAND, command)
+    if reply is not None:
+        return all(result.get('success') for result in reply)
+    try:
+        return subprocess.run(['swaymsg', command], stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL, check=False).returncode == 0
+    except OSError:
+        return False
+
+def cec_client(*lines):
+    """Run lines through a one-shot cec-client, for when the cec package isn't installed
+
+    Returns:
+        str: what cec-client printed
+    """
+    return subprocess.run(['cec-client', '-s', '-d', '1'], input='\n'.join(lines) + '\n',
+                          text=True, capture_output=True, timeout=30, check=True).stdout
+
+def cec_client_power():
+    """Ask the TV for its power state through cec-client: 'on', 'standby' or None"""
+    match = re.search(r'power status:\s*(\S+)', cec_client('pow 0'))
+    state = match.group(1) if match else None
+    # 'in transition ...' and 'unknown' are reported as unknown
+    return state if state in ('on', 'standby') else None
+
+def cec_worker():
+    """Own the CEC adapter: run queued commands and poll the TV's power state in between"""
+    global tvPower, tvInput
+    tv = None
+    if cec is not None:
+        try:
+            cec.init()
+            tv = cec.Device(cec.CECDEVICE_TV)
+            recentLogs("CEC adapter opened.")
+            tvPower = 'on' if tv.is_on() else 'standby'
+        except Exception as e:
+            recentLogs(f"CEC adapter unavailable ({e}), using cec-client per command.", level='warning')
+            tv = None
+    while True:
+        try:
+            # Poll only over an open session, a cec-client run per minute costs a full
+            # bus initialisation (and a logged failure on devices without an adapter)
+            command, arg = cecQueue.get(timeout=CEC_POLL_INTERVAL if tv is not None else None)
+        except queue.Empty:
+            command, arg = 'status', None
+        try:
+            if command == 'on':
+                if tv is not None:
+                    tv.power_on()
+                    cec.set_active_source()
+                    # Ask again once the TV had time to wake up
+                    threading.Timer(CEC_ACTIVE_SOURCE_RETRY, cecQueue.put, (('activeSource', None),)).start()
+                    tvPower = 'on'
+                else:
+                    cec_client('on 0', 'as')
+                    # cec-client doesn't say whether the TV obeyed, ask once it had time
+                    tvPower = None
+                    threading.Timer(CEC_ACTIVE_SOURCE_RETRY, cecQueue.put, (('status', None),)).start()
+                recentLogs("TV turned on.")
+            elif command == 'standby':
+                if tv is not None:
+                    tv.standby()
+                    tvPower = 'standby'
+                else:
+                    cec_client('standby 0')
+                    tvPower = None
+                    threading.Timer(CEC_ACTIVE_SOURCE_RETRY, cecQueue.put, (('status', None),)).start()
+                recentLogs("TV put in standby.")
+            elif command == 'activeSource' and tvPower == 'on':
+                # Skipped if the TV was put back in standby meanwhile, it could wake it
+                if tv is not None:
+                    cec.set_active_source()
+                else:
+                    cec_client('as')
+            elif command == 'input':
+                # Set Stream Path to HDMI port N (physical address N.0.0.0)
+                if tv is not None:
+                    cec.transmit(cec.CECDEVICE_BROADCAST, cec.CEC_OPCODE_SET_STREAM_PATH,
+                                 bytes([int(arg) << 4, 0]))
+                else:
+                    cec_client(f'tx 1F:86:{int(arg) << 4:02X}:00')
+                tvInput = arg
+                recentLogs(f"TV switched to HDMI {arg}.")
+            elif command == 'status':
+                if tv is not None:
+                    tvPower = 'on' if tv.is_on() else 'standby'
+                else:
+                    tvPower = cec_client_power()
+        except Exception as e:
+            recentLogs(f"CEC {command} failed: {e}", level='warning')
+
+def tv_command(command, arg=None):
+    """Queue a CEC command for the worker, starting it on first use
+
+    Args:
+        command (str): 'on', 'standby', 'input' (arg is the HDMI port) or 'status'
+        arg: command argument
+    """
+    start_cec_worker()
+    cecQueue.put((command, arg))
+
+def start_cec_worker():
+    """Start the CEC worker thread, which opens the adapter, if it isn't running yet"""
+    global cecThread
+    if cecThread is None:
+        cecThread = threading.Thread(target=cec_worker, daemon=True)
+        cecThread.start()
+
+
+# Player currently on screen, and the background task preparing the next one
+browserPID = None
+displayTask = None
+displayRequest = None
+displayCancel = None
+
+async def run_display(controlFile, signageFile, contentHash, cancel, previousTask):
+    """Prepare and swap in new content as a background task so the heartbeat keeps
+    its cadence during long downloads. A newer schedule sets cancel to abort it.
+    """
+    global browserPID, displayedContent
+    if previousTask is not None:
+        # Let a superseded task notice its cancel flag and unwind before we start
+        await asyncio.gather(previousTask, return_exceptions=True)
+    try:
+        newPID = await asyncio.to_thread(startDisplay, controlFile, signageFile, contentHash, cancel)
+        if cancel.is_set():
+            raise DownloadCancelled(signageFile)
+        # Checking if firefox is active, it won't be after the first boot
+        if browserPID and browserPID is not newPID:
+            if newPID:
+                await asyncio.to_thread(wait_until_rendering, newPID)
+            await asyncio.to_thread(stop_player, browserPID)
+        elif newPID and firstFrameUptime is None:
+            # Nothing was restored at boot, this is the first frame
+            if await asyncio.to_thread(wait_until_rendering, newPID, FIRST_FRAME_TIMEOUT):
+                mark_first_frame()
+        if newPID is not kioskBrowser and (newPID is None or player_windowless(newPID)):
+            # Audio only: nothing covers a parked kiosk browser's blank page
+            await asyncio.to_thread(kiosk_hide)
+        browserPID = newPID
+        displayedContent = (controlFile, signageFile, contentHash)
+        screenshotWake.set()
+        if newPID and currentPlaylist is None:
+            # The exact player command is kept so a cold boot skips sniffing and probing
+            # (long-lived players are re-driven through launchPlayer instead)
+            longLived = newPID is kioskBrowser or newPID is mpvPlayer
+            save_state({'kind': 'content', 'scriptPath': controlFile, 'contentPath': signageFile,
+                        'contentHash': contentHash,
+                        'player': None if longLived else list(newPID.args),
+                        **launchedMedia})
+    except DownloadCancelled:
+        recentLogs("Superseded by a newer schedule, download cancelled.")
+    except psutil.NoSuchProcess:
+        # Sometimes firefox's pid changes, I think it's cuz of the redirect for webpage viewing but
+        # the next schedule change starts clean anyway
+        recentLogs("firefox pid lost, restarting")
+    except Exception as e:
+        recentLogs('type is: ' + e.__class__.__name__)
+        recentLogs(str(e))
+        print_exc()
+        recentLogs("Could not start display, will retry on the next heartbeat")
+
+async def run_default(signageFile, contentHash, cancel, previousTask):
+    """Pull the DEFAULT content once and close the player, in the background"""
+    global browserPID
+    if previousTask is not None:
+        await asyncio.gather(previousTask, return_exceptions=True)
+    try:
+        # Clear all files
+        clearFiles()
+        # Pull Default ONCE
+        mediaPath = await asyncio.to_thread(fetch_media, signageFile, contentHash, cancel)
+        link_signage_file(mediaPath)
+        # Close the browser
+        if browserPID:
+            await asyncio.to_thread(stop_player, browserPID)
+            browserPID = None
+        # Nothing replaces a parked kiosk browser, don't leave its blank page up
+        await asyncio.to_thread(kiosk_hide)
+        save_state({'kind': 'default', 'contentPath': signageFile, 'contentHash': contentHash,
+                    'digest': os.path.basename(mediaPath)})
+    except DownloadCancelled:
+        recentLogs("Superseded by a newer schedule, download cancelled.")
+    except Exception as e:
+        recentLogs('type is: ' + e.__class__.__name__)
+        recentLogs(str(e))
+        recentLogs("Could not pull DEFAULT content, will retry on the next heartbeat")
+
+def save_state(state):
+    """Persist the schedule now on screen as the last known good state"""
+    tmpPath = STATE_PATH + '.tmp'
+    try:
+        with open(tmpPath, 'w') as f:
+            json.dump(state, f)
+            # Survive a power cut straight after a content change
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, STATE_PATH)
+    except OSError as e:
+        recentLogs(f"Failed to save state: {e}", level='warning')
+
+def _uptime_seconds():
+    with open('/proc/uptime', 'r') as f:
+        return float(f.read().split()[0])
+
+def mark_first_frame():
+    """Record when the first frame appeared after boot"""
+    global firstFrameUptime
+    firstFrameUptime = _uptime_seconds()
+    recentLogs(f"First frame {firstFrameUptime:.1f}s after boot, "
+               f"{firstFrameUptime - serviceStartUptime:.1f}s after service start.")
+
+def restore_last_known_good():
+    """Put the last known good schedule back on screen straight from the cache,
+    without any network I/O. The heartbeat reconciles with piman afterwards.
+
+    Returns:
+        PID: the restored player, or None
+    """
+    try:
+        with open(STATE_PATH, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    kind = state.get('kind')
+    if kind == 'playlist':
+        recentLogs("Restoring last playlist from cache.")
+        start_playlist(state['playlist'])
+        return None
+    blobPath = os.path.join(MEDIA_CACHE_DIR, state.get('digest', ''))
+    if not state.get('digest') or not os.path.exists(blobPath):
+        return None
+    link_signage_file(blobPath)
+    if kind != 'content':
+        return None
+    recentLogs("Restoring last content from cache.")
+    global displayedContent
+    displayedContent = (state.get('scriptPath', ''), state['contentPath'], state.get('contentHash'))
+    if state.get('player') and all(os.path.exists(arg) for arg in state['player'] if arg.startswith('/')):
+        global browserProfileSlot
+        for slot, profile in enumerate(BROWSER_PROFILES):
+            if profile in state['player']:
+                # The next page has to start on the other profile
+                browserProfileSlot = slot
+        return subprocess.Popen(state['player'], stdout=subprocess.DEVNULL,
+                                stderr=subprocess.STDOUT, env=player_env())
+    return launchPlayer(blobPath, state['fileType'])
+
+async def confirm_restored_frame(pid):
+    # A cold browser start on a Pi can take well over the usual swap timeout
+    if await asyncio.to_thread(wait_until_rendering, pid, FIRST_FRAME_TIMEOUT):
+        mark_first_frame()
+
+def player_rss(proc):
+    """Resident memory of a player and all its children (Firefox runs many processes)"""
+    try:
+        process = psutil.Process(proc.pid)
+        return sum(p.memory_info().rss for p in [process] + process.children(recursive=True))
+    except psutil.Error:
+        return 0
+
+def memory_pressure():
+    """PSI 'full avg10' memory pressure, the share of time all tasks stalled on memory"""
+    try:
+        with open('/proc/pressure/memory', 'r') as f:
+            for line in f:
+                if line.startswith('full'):
+                    return float(re.search(r'avg10=([\d.]+)', line).group(1))
+    except (OSError, AttributeError):
+        pass
+    return 0.0
+
+async def restart_player(reason):
+    """Bring the content on screen back up in a fresh player"""
+    global browserPID
+    player = browserPID
+    if player is None or displayedContent is None:
+        return
+    playerHealth['restarts'] += 1
+    recentLogs(f"Restarting player: {reason}", level='warning')
+    if player is kioskBrowser or player is mpvPlayer or player.poll() is not None:
+        # Long-lived players are restarted from scratch, a dead one has nothing to swap from
+        browserPID = None
+        if player is kioskBrowser:
+            await asyncio.to_thread(kiosk_stop)
+        elif player is mpvPlayer:
+            await asyncio.to_thread(mpv_stop)
+    # Otherwise the old player stays up until the new one renders, as on a schedule change
+    schedule_display(('Restart', playerHealth['restarts']), run_display, *displayedContent)
+
+async def supervisor_loop():
+    """Watch the player on screen: exit notification through a pidfd (polling where
+    pidfd_open isn't available), plus RSS and PSI memory pressure every interval.
+    """
+    loop = asyncio.get_running_loop()
+    exited = asyncio.Event()
+    watched, pidfd = None, None
+    crashes = collections.deque()
+    backedOff = None  # the crashed player we already counted and waited out
+    lastMemoryAction = 0
+    pressured = 0
+    while True:
+        if browserPID is not watched:
+            if pidfd is not None:
+                loop.remove_reader(pidfd)
+                os.close(pidfd)
+                pidfd = None
+            watched = browserPID
+            exited.clear()
+            if watched is not None:
+                try:
+                    pidfd = os.pidfd_open(watched.pid)
+                    loop.add_reader(pidfd, exited.set)
+                except (AttributeError, OSError):
+                    pidfd = None
+        try:
+            await asyncio.wait_for(exited.wait(), SUPERVISOR_INTERVAL if pidfd is not None else 5)
+        except asyncio.TimeoutError:
+            pass
+        # A swap in progress retires the old player on purpose
+        if watched is None or watched is not browserPID or displayedContent is None \
+                or (displayTask is not None and not displayTask.done()):
+            if exited.is_set():
+                # Don't spin on an exit we are deliberately ignoring
+                await asyncio.sleep(1)
+            continue
+        now = time.monotonic()
+        if watched.poll() is not None:
+            if pidfd is not None:
+                loop.remove_reader(pidfd)
+            if watched is not backedOff:
+                playerHealth['crashes'] += 1
+                crashes.append(now)
+            while crashes and now - crashes[0] > PLAYER_CRASH_WINDOW:
+                crashes.popleft()
+            if len(crashes) > PLAYER_MAX_CRASHES:
+                backedOff = watched
+                recentLogs(f"Player crashed {len(crashes)} times in {PLAYER_CRASH_WINDOW}s, "
+                           "waiting before restarting it again.", level='error')
+                await asyncio.sleep(PLAYER_CRASH_WINDOW)
+                crashes.clear()
+                # The schedule may have moved on while we waited, let the checks above decide
+                continue
+            await restart_player(f"exited with code {watched.returncode}")
+            continue
+
+        rss = await asyncio.to_thread(player_rss, watched)
+        pressure = memory_pressure()
+        playerHealth['rss'] = rss
+        playerHealth['rssPeak'] = max(playerHealth['rssPeak'], rss)
+        playerHealth['memoryPressurePeak'] = max(playerHealth['memoryPressurePeak'], pressure)
+        pressured = pressured + 1 if pressure > MEMORY_PRESSURE_LIMIT else 0
+        if now - lastMemoryAction < MEMORY_ACTION_INTERVAL:
+            continue
+        if rss > PLAYER_MAX_RSS:
+            lastMemoryAction = now
+            await restart_player(f"using {rss // (1024 * 1024)} MiB, over its {PLAYER_MAX_RSS // (1024 * 1024)} MiB budget")
+        elif pressured >= 2:
+            lastMemoryAction = now
+            if watched is kioskBrowser:
+                # A reload drops what the page accumulated without a cold browser start
+                playerHealth['refreshes'] += 1
+                recentLogs(f"Memory pressure {pressure}%, reloading the page.", level='warning')
+                await asyncio.to_thread(kiosk_refresh)
+            else:
+                await restart_player(f"memory pressure {pressure}%")
+
+def schedule_display(request, coro_fn, *args):
+    """Start a display task for request unless that same request is already in flight,
+    cancelling whatever older request is still downloading.
+
+    Args:
+        request (tuple): identifies the schedule, e.g. (status, scriptPath, contentPath)
+        coro_fn (coroutine function): run_display or run_default
+    """
+    global displayTask, displayRequest, displayCancel
+    if displayTask is not None and not displayTask.done():
+        if request == displayRequest:
+            return
+        recentLogs("Newer schedule received, cancelling in-flight download.")
+        displayCancel.set()
+    displayCancel = threading.Event()
+    displayRequest = request
+    displayTask = asyncio.create_task(coro_fn(*args, displayCancel, displayTask))
+
+def frame_hash(ppm):
+    """Reduce a binary PPM frame to per-tile mean brightness values
+
+    Args:
+        ppm (bytes): P6 image as written by grim -t ppm
+
+    Returns:
+        list: SCREENSHOT_HASH_GRID ** 2 tile means in 0-255
+    """
+    header = re.match(rb'P6\s+(\d+)\s+(\d+)\s+\d+\s', ppm)
+    width, height = int(header.group(1)), int(header.group(2))
+    offset = header.end()
+    stride = width * 3
+    grid = SCREENSHOT_HASH_GRID
+    tileW, tileH = max(width // grid, 1), max(height // grid, 1)
+    # Every other row is plenty for a brightness mean and halves the work
+    rowStep = 2 if tileH > 1 else 1
+    tiles = []
+    for ty in range(grid):
+        rows = range(ty * tileH, min((ty + 1) * tileH, height), rowStep)
+        for tx in range(grid):
+            start = tx * tileW * 3
+            end = start + tileW * 3
+            # sum() over a bytes slice runs in C, no per-pixel Python loop
+            total = sum(sum(ppm[offset + y * stride + start:offset + y * stride + end]) for y in rows)
+            count = len(rows) * tileW * 3
+            tiles.append(total // count if count else 0)
+    return tiles
+
+def frame_changed(previous, current):
+    """Compare two frame hashes with enough tolerance to ignore encoder noise"""
+    if previous is None or len(previous) != len(current):
+        return True
+    changedTiles = sum(1 for a, b in zip(previous, current) if abs(a - b) > SCREENSHOT_HASH_TILE_DELTA)
+    return changedTiles > SCREENSHOT_HASH_TILES
+
+def takeScreenshot(piName):
+    """Capture the display with grim and upload it to piman for the dashboard,
+    skipping the upload when the frame has not visibly changed.
+
+    Returns:
+        bool: True if a changed frame was uploaded
+    """
+    global lastScreenshotHash, lastScreenshotUpload
+    # A small PPM capture is cheap to produce and to hash
+    try:
+        capture = subprocess.run(['grim', '-s', str(SCREENSHOT_SCALE), '-t', 'ppm', '-'],
+                                 capture_output=True,
+                                 check=True)
+    except subprocess.CalledProcessError as e:
+        recentLogs(f"Error taking screenshot: {e}", level='error')
+        recentLogs(f"Error output: {e.stderr.decode(errors='replace')}", level='error')
+        return False
+    currentHash = frame_hash(capture.stdout)
+    changed = frame_changed(lastScreenshotHash, currentHash)
+    if not changed and time.time() - lastScreenshotUpload < SCREENSHOT_MAX_AGE:
+        return False
+
+    # Only encode the upload copy when it is actually going to be sent, from the
+    # frame already captured so grim doesn't have to grab the screen a second time
+    extension = 'jpg' if SCREENSHOT_FORMAT == 'jpeg' else SCREENSHOT_FORMAT
+    command = ['ffmpeg', '-v', 'error', '-f', 'ppm_pipe', '-i', '-', '-frames:v', '1']
+    if SCREENSHOT_FORMAT == 'jpeg':
+        # ffmpeg's JPEG scale runs from 2 (best) to 31, SCREENSHOT_QUALITY is grim's 0-100
+        command += ['-c:v', 'mjpeg', '-q:v', str(round(2 + (100 - SCREENSHOT_QUALITY) * 29 / 100))]
+    else:
+        command += ['-c:v', 'png']
+    try:
+        encoded = subprocess.run(command + ['-f', 'image2pipe', '-'],
+                                 input=capture.stdout,
+                                 capture_output=True,
+                                 check=True)
+    except subprocess.CalledProcessError as e:
+        recentLogs(f"Error encoding screenshot: {e}", level='error')
+        recentLogs(f"Error output: {e.stderr.decode(errors='replace')}", level='error')
+        return False
+    data = {'piName': piName}
+    files = {'file': (f"{piName}.{extension}", encoded.stdout, f'image/{SCREENSHOT_FORMAT}')}
+    # Longer timeout for image file upload
+    response = get_http_client().post(f'{BASE_URL}/UploadPiScreenshot',
+                                      data=data,
+                                      files=files,
+                                      timeout=10)
+    response.raise_for_status()
+    lastScreenshotHash = currentHash
+    lastScreenshotUpload = time.time()
+    return changed
+
+async def screenshot_loop():
+    """Screenshots run on their own schedule so a slow capture or upload never
+    delays the heartbeat. Upload failures do not count as lost connections.
+    """
+    piName = os.uname()[1]
+    interval = SCREENSHOT_INTERVAL
+    # Captures left at the short interval after a content switch
+    boost = 0
+    while True:
+        try:
+            changed = await asyncio.to_thread(takeScreenshot, piName)
+            if boost:
+                boost -= 1
+                interval = SCREENSHOT_MIN_INTERVAL
+            else:
+                # Back off while the display is static, return to normal once it moves
+                interval = SCREENSHOT_INTERVAL if changed else min(interval * 2, SCREENSHOT_MAX_INTERVAL)
+        except Exception as e:
+            recentLogs(f"Screenshot upload failed: {e}", level='warning')
+            interval = SCREENSHOT_INTERVAL
+        try:
+            await asyncio.wait_for(screenshotWake.wait(), timeout=interval)
+            # Content just switched, capture it now and watch it closely for a while
+            screenshotWake.clear()
+            boost = 3
+        except asyncio.TimeoutError:
+            pass
+
+previous_status = None
+
+def handle_status(data):
+    """Act on a schedule or command from piman, whether it came back from the
+    piConnect heartbeat or was pushed over the event stream.
+
+    Args:
+        data (dict): piConnect style payload with status, scriptPath and contentPath
+    """
+    global previous_status, legacyCommand
+    load_commands()
+    status = data['status']
+    # Only log if status has changed
+    if status != previous_status:
+        recentLogs(f"Status: {status}")
+
+    if status not in ("Command", "NoChange") and legacyCommand is not None:
+        # A new schedule replaced the command, the same command may be issued again
+        legacyCommand = None
+        save_commands()
+
+    # Queued commands ride along with any status, each runs once by id
+    for command in data.get('commands', []):
+        dispatch_command(command['id'], command['command'], command.get('scriptPath', ''))
+
+    # Special case "command" keyword from scriptPath, causes pi to execute
+    # command script using flags included in contentPath.
+    if status == "Command":
+        commandFile = data['scriptPath']
+        commandFlags = data['contentPath']
+        if status != previous_status:
+            recentLogs("do command things")
+            recentLogs(f"Command Flags: {commandFlags}")
+            recentLogs(f"Command File: {commandFile}")
+        if data.get('commandId'):
+            dispatch_command(data['commandId'], commandFlags, commandFile)
+        else:
+            # An id-less command is re-sent every heartbeat until the schedule
+            # changes, so it only runs when it first appears
+            if legacyCommand != f"{commandFile}|{commandFlags}":
+                legacyCommand = f"{commandFile}|{commandFlags}"
+                dispatch_command(f"legacy-{time.time_ns()}", commandFlags, commandFile)
+
+    # We don't want the pi to update on every loop if content is the same.
+    elif status == "NoChange":
+        if status != previous_status:
+            recentLogs("No schedule change detected.")
+
+    elif status == "Playlist":
+        # Re-sent every heartbeat, only a different playlist restarts the rotation
+        if data['playlist'] != currentPlaylist:
+            recentLogs(f"Starting local playlist of {len(data['playlist'].get('items', []))} items.")
+            start_playlist(data['playlist'])
+
+    elif status == "DEFAULT":
+        if status != previous_status:
+            stop_playlist()
+            recentLogs("Detected DEFAULT status.")
+            signageFile = data['contentPath']
+            schedule_display((status, signageFile), run_default,
+                             signageFile, data.get('contentHash'))
+
+    else:
+        # Pull the paths of the files from the server response so we can download each.
+        # The current player keeps running while the next asset is downloaded
+        # and its player started, and is only killed once the new one renders.
+        stop_playlist()
+        controlFile = data['scriptPath']
+        signageFile = data['contentPath']
+        schedule_display((status, controlFile, signageFile), run_display,
+                         controlFile, signageFile, data.get('contentHash'))
+
+    previous_status = status
+
+def _parse_window_time(value, now):
+    """Turn an 'HH:MM' (today) or ISO timestamp into a naive local datetime"""
+    if len(value) <= 5:
+        hours, minutes = (int(v) for v in value.split(':'))
+        return now.replace(hour=hours, minute=minutes, second=0, microsecond=0)
+    when = datetime.datetime.fromisoformat(value)
+    if when.tzinfo is not None:
+        # Compared against naive local time, so convert offsets like +00:00 to local
+        when = when.astimezone().replace(tzinfo=None)
+    return when
+
+def item_window(item, now):
+    """Return (active, seconds until the window ends or None, seconds until it opens or None)"""
+    if not item.get('start') and not item.get('end'):
+        return True, None, None
+    start = _parse_window_time(item['start'], now) if item.get('start') else None
+    end = _parse_window_time(item['end'], now) if item.get('end') else None
+    daily = all(len(item.get(key) or '') <= 5 for key in ('start', 'end'))
+    if daily and start and end and end <= start:
+        # Window crosses midnight
+        if now >= start or now < end:
+            if now >= start:
+                end += datetime.timedelta(days=1)
+            return True, (end - now).total_seconds(), None
+        return False, None, (start - now).total_seconds()
+    if start and now < start:
+        return False, None, (start - now).total_seconds()
+    if end and now >= end:
+        if daily and start:
+            return False, None, (start + datetime.timedelta(days=1) - now).total_seconds()
+        return False, None, None
+    return True, (end - now).total_seconds() if end else None, None
+
+def show_playlist_item(index, item):
+    """Swap a playlist item onto the screen unless it is already there"""
+    global playingItem
+    if playingItem == index:
+        return
+    playingItem = index
+    recentLogs(f"Playlist item {index}: {item['contentPath']}")
+    schedule_display(('Playlist', index, item['contentPath']), run_display,
+                     item.get('scriptPath', ''), item['contentPath'], item.get('contentHash'))
+
+async def prefetch_playlist(items, index):
+    """Download the next couple of items, and any whose window opens soon, into the cache"""
+    now = datetime.datetime.now()
+    upcoming = [(index + offset) % len(items) for offset in (1, 2)]
+    for position, item in enumerate(items):
+        opensIn = item_window(item, now)[2]
+        if opensIn is not None and opensIn <= PLAYLIST_PREFETCH_AHEAD:
+            upcoming.append(position)
+    for position in dict.fromkeys(upcoming):
+        item = items[position]
+        try:
+            mediaPath = await asyncio.to_thread(fetch_media, item['contentPath'], item.get('contentHash'),
+                                               bulk=True)
+            pinnedDigests.add(os.path.basename(mediaPath))
+            # Render the next page in a background tab so its swap is a tab switch
+            if position == upcoming[0] and magic.from_file(mediaPath, mime=True) == 'text/html':
+                await asyncio.to_thread(kiosk_preload, 'file://' + os.path.realpath(mediaPath))
+        except Exception as e:
+            recentLogs(f"Prefetch of playlist item {position} failed: {e}", level='warning')
+
+async def playlist_loop(playlist):
+    """Rotate through the playlist on a local timer"""
+    global prefetchTask
+    items = playlist.get('items', [])
+    loop = playlist.get('loop', True)
+    position = 0
+    while True:
+        now = datetime.datetime.now()
+        windows = [item_window(item, now) for item in items]
+        active = [i for i, window in enumerate(windows) if window[0]]
+        if not active:
+            # Nothing scheduled right now, wait for the next window to open
+            opening = [window[2] for window in windows if window[2] is not None]
+            await asyncio.sleep(min(opening + [30]))
+            continue
+        later = [i for i in active if i >= position]
+        index = later[0] if later else (active[0] if loop else active[-1])
+        item = items[index]
+        show_playlist_item(index, item)
+        if prefetchTask is None or prefetchTask.done():
+            prefetchTask = asyncio.create_task(prefetch_playlist(items, index))
+        duration = item.get('duration') or PLAYLIST_DEFAULT_DURATION
+        if windows[index][1] is not None:
+            duration = min(duration, windows[index][1])
+        await asyncio.sleep(max(duration, 1))
+        position = index + 1
+        if position >= len(items):
+            # Without loop the last item is held until its window closes
+            position = 0 if loop else index
+
+def start_playlist(playlist):
+    """Run a new playlist locally, replacing any running one"""
+    global currentPlaylist, playlistTask, playingItem
+    stop_playlist()
+    currentPlaylist = playlist
+    playingItem = None
+    playlistTask = asyncio.create_task(playlist_loop(playlist))
+    save_state({'kind': 'playlist', 'playlist': playlist})
+
+def stop_playlist():
+    """Stop the local playlist, e.g. because a single piece of content was scheduled"""
+    global currentPlaylist, playlistTask, playingItem
+    if playlistTask is not None:
+        playlistTask.cancel()
+        if prefetchTask is not None:
+            prefetchTask.cancel()
+        recentLogs("Stopping local playlist.")
+    currentPlaylist = None
+    playlistTask = None
+    playingItem = None
+    pinnedDigests.clear()
+
+def encode_heartbeat(parameters):
+    """Turn the full heartbeat into the request body actually sent to piConnect
+
+    Args:
+        parameters (dict): every heartbeat field
+
+    Returns:
+        tuple: (body bytes, request headers)
+    """
+    payload = parameters
+    if heartbeatDeltaOk:
+        # logEntries already only holds unacknowledged entries, the legacy
+        # piLogs copy of the tail is not needed by a delta-aware server
+        payload = {key: value for key, value in parameters.items()
+                   if key in HEARTBEAT_ALWAYS_FIELDS or key in ('logEntries', 'commandAcks')
+                   or (key != 'piLogs' and heartbeatLastSent.get(key) != value)}
+        payload['delta'] = True
+
+    if heartbeatEncoding == 'msgpack':
+        return msgpack.packb(payload), {'Content-Type': 'application/msgpack'}
+    body = json.dumps(payload).encode()
+    if heartbeatEncoding == 'gzip':
+        return gzip.compress(body), {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+    return body, {'Content-Type': 'application/json'}
+
+def heartbeat_accepted(parameters, data):
+    """Remember what piman now holds after a successful heartbeat
+
+    Args:
+        parameters (dict): the full heartbeat fields that were sent
+        data (dict): the piConnect response
+    """
+    global heartbeatDeltaOk, heartbeatEncoding, heartbeatLastSent
+    if data.get('resync'):
+        recentLogs("Server requested a full heartbeat resync.")
+        heartbeatDeltaOk = False
+        heartbeatLastSent = {}
+    else:
+        heartbeatDeltaOk = bool(data.get('deltaOk'))
+        heartbeatLastSent = parameters
+        # Servers that don't ack explicitly are taken to have stored what was sent
+        sentEntries = parameters.get('logEntries')
+        acknowledge_logs(data.get('logAck', sentEntries[-1]['seq'] if sentEntries else 0))
+        acknowledge_commands(data.get('commandAck', [ack['id'] for ack in parameters.get('commandAcks', [])]))
+    accepted = data.get('acceptEncodings', [])
+    if msgpack is not None and 'msgpack' in accepted:
+        heartbeatEncoding = 'msgpack'
+    elif 'gzip' in accepted:
+        heartbeatEncoding = 'gzip'
+    else:
+        heartbeatEncoding = None
+
+async def push_loop():
+    """Hold a Server-Sent Events stream open to piman and handle each pushed
+    schedule or command as soon as it arrives, reconnecting with backoff.
+    Each event's data is a JSON payload shaped like a piConnect response.
+    """
+    global pushConnected
+    piName = os.uname()[1]
+    retryDelay = 5
+    # Read timeout well above the server's keep-alive comment interval
+    timeout = httpx.Timeout(10, read=60)
+    async with httpx.AsyncClient(timeout=timeout, **http_client_options(asynchronous=True)) as client:
+        while True:
+            try:
+                async with client.stream('GET', f'{BASE_URL}/piEvents',
+                                         params={'name': piName},
+                                         headers={'Accept': 'text/event-stream'}) as r:
+                    r.raise_for_status()
+                    pushConnected = True
+                    retryDelay = 5
+                    recentLogs("Push channel connected.")
+                    dataLines = []
+                    async for line in r.aiter_lines():
+                        if line.startswith('data:'):
+                            dataLines.append(line[5:].strip())
+                        elif line == '' and dataLines:
+                            # A blank line ends the event
+                            try:
+                                handle_status(json.loads('\n'.join(dataLines)))
+                            except Exception as e:
+                                recentLogs(f"Could not handle pushed event: {e}")
+                            dataLines = []
+            except (httpx.HTTPError, ValueError) as e:
+                if pushConnected:
+                    recentLogs(f"Push channel lost ({e}), falling back to polling.")
+            pushConnected = False
+            await asyncio.sleep(retryDelay)
+            retryDelay = min(retryDelay * 2, 300)
+
+async def peer_loop():
+    """Announce this device's cached blobs to the LAN and forget silent peers"""
+    try:
+        await asyncio.to_thread(start_peer_server)
+        sock = peer_socket()
+    except OSError as e:
+        recentLogs(f"Peer sharing unavailable: {e}", level='warning')
+        return
+    threading.Thread(target=listen_for_peers, args=(sock,), daemon=True).start()
+    while True:
+        try:
+            sock.sendto(peer_announcement(), (PEER_GROUP, PEER_ANNOUNCE_PORT))
+        except OSError as e:
+            recentLogs(f"Peer announcement failed: {e}", level='warning')
+        for key, peer in list(peers.items()):
+            if time.monotonic() - peer['seen'] > 3 * PEER_ANNOUNCE_INTERVAL:
+                del peers[key]
+        await asyncio.sleep(PEER_ANNOUNCE_INTERVAL)
+
+def next_heartbeat_delay(failures, retryAfter=None):
+    """Seconds to wait before the next heartbeat
+
+    Args:
+        failures (int): consecutive failed heartbeats
+        retryAfter (str, optional): Retry-After header from an overloaded piman
+
+    Returns:
+        float: jittered delay
+    """
+    if failures == 0:
+        base = PUSH_HEARTBEAT_INTERVAL if pushConnected else heartbeatInterval
+        return base * random.uniform(1 - HEARTBEAT_JITTER, 1 + HEARTBEAT_JITTER)
+    if retryAfter and retryAfter.isdigit():
+        return min(int(retryAfter), HEARTBEAT_MAX_BACKOFF) * random.uniform(1, 1 + HEARTBEAT_JITTER)
+    # Exponential backoff with equal jitter: half fixed, half random
+    backoff = min(HEARTBEAT_INTERVAL * 2 ** (failures - 1), HEARTBEAT_MAX_BACKOFF)
+    return random.uniform(backoff / 2, backoff)
+
+def apply_interval_hint(data):
+    """Adopt the heartbeat interval piman asks for, within sane bounds"""
+    global heartbeatInterval
+    hint = data.get('heartbeatInterval')
+    if isinstance(hint, (int, float)) and not isinstance(hint, bool):
+        hint = min(max(hint, HEARTBEAT_MIN_INTERVAL), HEARTBEAT_MAX_BACKOFF)
+        if hint != heartbeatInterval:
+            recentLogs(f"Heartbeat interval set to {hint}s by piman.")
+            heartbeatInterval = hint
+
+async def main():
     """pisignage control, pings server to check content schedule, downloading new content when
     updated, downloads control scripts for running media on each update,
     uploads screenshot to server for dashboard monitoring.
-    """
 
+    The heartbeat runs on the event loop and keeps its cadence, downloads and
+    player start-up run as display tasks and screenshots run as their own task.
+    """
+    global screenshotWake, serviceStartUptime, browserPID
+    serviceStartUptime = _uptime_seconds()
     recentLogs("Service Starting...")
 
     clearFiles()
-    browserPID = None
-    ipAddress = getIP()
-    loadAvg = getLoadAverages()
-    loopDelayCounter = 0
-    ScreenResolution = getScreenResolution()
-    timeSinceLastConnection = 0
+    # Escalation is by wall-clock time offline, not by how many attempts fit in it
+    lastConnected = time.monotonic()
+    failures = 0
+    metricsSince = 0
     networking_restarted = False
-    previous_status = None
-    default_hash = None
 
     os.environ['WAYLAND_DISPLAY'] = os.environ.get('WAYLAND_DISPLAY', 'wayland-1')
     os.environ['XDG_RUNTIME_DIR'] = os.environ.get('XDG_RUNTIME_DIR', f'/run/user/{os.getuid()}')
 
+    screenshotWake = asyncio.Event()
+    # Output events are watched from boot so the reported resolution is always current
+    await asyncio.to_thread(sway_connect)
+    # Last known good content goes up before anything touches the network
+    browserPID = restore_last_known_good()
+    if browserPID:
+        firstFrameTask = asyncio.create_task(confirm_restored_frame(browserPID))
+    screenshotTask = asyncio.create_task(screenshot_loop())
+    metricsTask = asyncio.create_task(metrics_loop())
+    supervisorTask = asyncio.create_task(supervisor_loop())
+    if PUSH_ENABLED:
+        pushTask = asyncio.create_task(push_loop())
+    if cec is not None:
+        # Open the adapter now so the first power action doesn't pay for it
+        start_cec_worker()
+    if PEERS_ENABLED:
+        peerTask = asyncio.create_task(peer_loop())
+    if TRANSCODE_ENABLED:
+        transcodeTask = asyncio.create_task(transcode_loop())
+    if load_decode_profile() is None:
+        # First boot, or ffmpeg/hardware changed: measure decode capability in the background
+        benchmarkTask = asyncio.create_task(asyncio.to_thread(run_decode_benchmark))
+
     while True:
-        uptime = getUptime()
-        if loopDelayCounter == 5:
+        try:
+            # All of these are read in-process now, so they are fresh every heartbeat
+            uptime = getUptime()
+            loadAvg = getLoadAverages()
             ipAddress = getIP()
             ScreenResolution = getScreenResolution()
-            loopDelayCounter = 0
-        loopDelayCounter += 1
-        # Checks if signageFile exists first then checksums.
-        # else 0.
-
-        # first loop 0 since no files should exist
-        if os.path.exists('/tmp/signageFile'):
-            hash = md5checksum('/tmp/signageFile')
-        else:
-            hash = 0
-
-        # Build data parameters for server post request
-        parameters = {}
-        piName = os.uname()[1]
-        parameters["hash"] = hash
-        parameters["load"] = loadAvg
-        parameters["name"] = piName
-        parameters["ipAddr"] = ipAddress
-        parameters["piLogs"] = logList
-        parameters["uptime"] = uptime
-        parameters["hardware"] = DEVICE_MODEL
-        parameters["screenRes"] = ScreenResolution
-        parameters["clientVersion"] = PI_CLIENT_VERSION
-        parameters["os"] = OS_INFO
-
-        try:
-            # timeout=None cuz in some cases the posts would time out.
+
+            # Checks if signageFile exists first then checksums.
+            # else 0.
+
+            # first loop 0 since no files should exist
+            if os.path.exists(SIGNAGE_FILE):
+                hash = await asyncio.to_thread(md5checksum, SIGNAGE_FILE)
+            else:
+                hash = 0
+
+            # Build data parameters for server post request
+            parameters = {}
+            piName = os.uname()[1]
+            parameters["hash"] = hash
+            parameters["load"] = loadAvg
+            parameters["name"] = piName
+            parameters["ipAddr"] = ipAddress
+            parameters["piLogs"] = legacy_log_lines()
+            parameters["logEntries"] = unacked_log_entries()
+            parameters["uptime"] = uptime
+            parameters["hardware"] = DEVICE_MODEL
+            parameters["screenRes"] = ScreenResolution
+            parameters["clientVersion"] = PI_CLIENT_VERSION
+            parameters["os"] = OS_INFO
+            parameters["httpTimings"] = dict(httpTimings)
+            parameters["metrics"] = summarize_metrics(metricsSince)
+            if firstFrameUptime is not None:
+                parameters["bootToFirstFrame"] = round(firstFrameUptime, 1)
+            parameters["playerHealth"] = dict(playerHealth)
+            load_commands()
+            with commandsLock:
+                if commandAcks:
+                    # Copies, the command worker updates entries in place
+                    parameters["commandAcks"] = [dict(ack) for ack in commandAcks]
+            if cecThread is not None:
+                parameters["tvPower"] = tvPower
+                parameters["tvInput"] = tvInput
+            if PEERS_ENABLED:
+                parameters["peers"] = {'count': len(peers), **peerStats}
+            playerStats = await asyncio.to_thread(player_stats)
+            if playerStats is not None:
+                parameters["playerStats"] = playerStats
+            if currentPlaylist is not None:
+                # The hash changes with every rotation, this says which item is showing
+                parameters["playlistId"] = currentPlaylist.get('id')
+                parameters["playingItem"] = playingItem
+
+            content, headers = encode_heartbeat(parameters)
             # Might need to change to 5 seconds if going too long causes a crash.
-            response = httpx.post(
-                f'{BASE_URL}/piConnect', json=parameters, timeout=5)
+            response = await asyncio.to_thread(
+                get_http_client().post,
+                f'{BASE_URL}/piConnect', content=content, headers=headers, timeout=5)
 
             # Check for status of 2XX in httpx response
             response.raise_for_status()
+            heartbeat_accepted(parameters, response.json())
+            apply_interval_hint(response.json())
+            metricsSince = time.time()
 
-            # Reset failure counter as soon as the main server connection is confirmed.
-            # Keeping this here (not near the screenshot upload) means a failed
+            # Reset the outage clock as soon as the main server connection is confirmed.
+            # Keeping this here (not in the screenshot task) means a failed
             # screenshot upload cannot falsely count as a server connection failure.
-            timeSinceLastConnection = 0
+            lastConnected = time.monotonic()
+            failures = 0
             networking_restarted = False
 
-            status = response.json()['status']
-            # Only log if status has changed
-            if status != previous_status:
-                recentLogs(f"Status: {status}")
-
-            # Special case "command" keyword from scriptPath, causes pi to execute
-            # command script using flags included in contentPath.
-            if status == "Command":
-                commandFile = response.json()['scriptPath']
-                commandFlags = response.json()['contentPath']
-                if status != previous_status:
-                    recentLogs("do command things")
-                    recentLogs(f"Command Flags: {commandFlags}")
-                    recentLogs(f"Command File: {commandFile}")
-                # Execute command every loop, not just on status change
-                if commandFlags == "Restart":
-                    recentLogs("Rebooting...")
-                    os.system("sudo reboot")
-                elif commandFlags == "RestartProcess":
-                    recentLogs("Restarting piman service...")
-                    os.system("systemctl --user restart piman.service")
-                elif commandFlags == "RotatePortraitLeft":
-                    recentLogs("Rotating screen portrait left (270)...")
-                    if os.system("swaymsg output '*' transform 270") == 0:
-                        set_sway_transform(270)
-                elif commandFlags == "RotatePortraitRight":
-                    recentLogs("Rotating screen portrait right (90)...")
-                    if os.system("swaymsg output '*' transform 90") == 0:
-                        set_sway_transform(90)
-                elif commandFlags == "RotateLandscape":
-                    recentLogs("Rotating screen landscape (0)...")
-                    if os.system("swaymsg output '*' transform 0") == 0:
-                        set_sway_transform(0)
-
-            # We don't want the pi to update on every loop if content is the same.
-            elif status == "NoChange":
-                if status != previous_status:
-                    recentLogs("No schedule change detected.")
-
-            elif status == "DEFAULT":
-                if status != previous_status:
-                    recentLogs("Detected DEFAULT status.")
-                    # Clear all files
-                    clearFiles()
-                    # Pull Default ONCE
-                    signageFile = response.json()['contentPath']
-                    downloadFile(signageFile, '/tmp/signageFile')
-                    hash = md5checksum('/tmp/signageFile')
-                    # Close the browser
-                    if browserPID:
-                        kill(browserPID.pid)
+            handle_status(response.json())
 
-            else:
-                # Clear all files before we download more.
-                clearFiles()
-                # Checking if firefox is active, it won't be after the first boot
-                if browserPID:
-                    kill(browserPID.pid)
-                # Pull the paths of the files from the server response so we can download each
-                controlFile = response.json()['scriptPath']
-                signageFile = response.json()['contentPath']
-                browserPID = startDisplay(controlFile, signageFile)
-            # Take a screenshot of the display
-            ssPath = f"/tmp/{piName}.png"
-            screenshot_taken = False
-            try:
-                subprocess.run(['grim',
-                            ssPath],
-                            capture_output=True,
-                            text=True,
-                            check=True)
-                screenshot_taken = True
-            except subprocess.CalledProcessError as e:
-                recentLogs(f"Error taking screenshot: {e}")
-                recentLogs(f"Error output: {e.stderr}")
-            # Only upload screenshot if grim succeeded
-            if screenshot_taken:
-                data = {'piName': piName}
-                with open(ssPath, 'rb') as ssFile:
-                    files = {'file': ssFile}
-                    # Longer timeout for image file upload
-                    httpx.post(f'{BASE_URL}/UploadPiScreenshot',
-                               data=data,
-                               files=files,
-                               timeout=10)
-            # Main loop speed control
-            time.sleep(30)
-
-            previous_status = status
+            # Main loop speed control, changes arrive instantly while push is connected
+            await asyncio.sleep(next_heartbeat_delay(0))
 
 # Exceptions
         except httpx.HTTPError as http_exc:
-            recentLogs(f"HTTP Error: {http_exc}")
+            recentLogs(f"HTTP Error: {http_exc}", level='error')
             print(f"HTTP Error: {http_exc}")
-            timeSinceLastConnection += 1
-            # After 60 consecutive failed attempts (~30 min), restart networking once.
-            # The >= check with a flag ensures this fires exactly once even if the
-            # counter skips a value. This process (piman.service) keeps running after
-            # the restart, so the counter continues to increment if not restored.
-            if timeSinceLastConnection >= 60 and not networking_restarted:
+            failures += 1
+            offline = time.monotonic() - lastConnected
+            # After 30 minutes offline, restart networking once. The flag ensures
+            # this fires exactly once. This process (piman.service) keeps running
+            # after the restart, so the outage clock keeps running if not restored.
+            if offline >= NETWORK_RESTART_AFTER and not networking_restarted:
                 networking_restarted = True
                 recentLogs("Lost connection for 30 minutes, restarting networking...")
-                os.system('sudo systemctl restart networking')
-            # After 120 consecutive failed attempts (~60 min), networking restart did
-            # not restore connectivity — escalate to a full reboot.
-            elif timeSinceLastConnection >= 120:
+                await asyncio.to_thread(os.system, 'sudo systemctl restart networking')
+            # After 60 minutes offline the networking restart did not restore
+            # connectivity — escalate to a full reboot.
+            elif offline >= REBOOT_AFTER:
                 recentLogs("Lost connection for 60 minutes, rebooting...")
                 os.system('sudo reboot')
-            print(f"Unable to reach piman. Current tally is {timeSinceLastConnection}")
-            time.sleep(30)
-        except psutil.NoSuchProcess:
-            # Sometimes firefox's pid changes, I think it's cuz of the redirect for webpage viewing but
-            # this catches it and another loop fixes it when it happens, so just loop again quickly
-            time.sleep(1)
-            recentLogs("firefox pid lost, restarting")
+            print(f"Unable to reach piman for {offline:.0f}s ({failures} attempts)")
+            retryAfter = None
+            if isinstance(http_exc, httpx.HTTPStatusError):
+                retryAfter = http_exc.response.headers.get('retry-after')
+            await asyncio.sleep(next_heartbeat_delay(failures, retryAfter))
         except Exception as e:
             # General exception so that loop never crashes out, it will print it to the logs
-            recentLogs('type is: ' + e.__class__.__name__)
-            recentLogs(str(e))
+            recentLogs('type is: ' + e.__class__.__name__, level='error')
+            recentLogs(str(e), level='error')
             print_exc()
-            recentLogs("Caught an error...waiting and will try again")
-            # This timeout is if server is down or has minor issue, small delay to let it sort out
-            time.sleep(15)
-
-main()
+            recentLogs("Caught an error...waiting and will try again", level='error')
+            # Server is down or has a minor issue, back off to let it sort out
+            failures += 1
+            await asyncio.sleep(next_heartbeat_delay(failures))
+
+if '--benchmark' in sys.argv:
+    # Run from the installer to measure decode capability before first playback
+    run_decode_benchmark()
+else:
+    asyncio.run(main())